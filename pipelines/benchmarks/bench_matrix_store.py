@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Compares the load times of an expression matrix saved as CSV (quant/salmon_TPM.csv) and as a MatrixStore,
+# for the whole matrix and for subsets of samples and genes
+# usage: python benchmarks/bench_matrix_store.py [matrix.csv]
+# without a CSV file, a random matrix of 60000 genes x 100 samples is used
+
+import os, sys, time, tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tools.matrix_store import MatrixStore
+
+def timeit(f, repeat=3):
+    """Best time of a few calls"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def main(csv_fn=None, n_genes=60000, n_samples=100, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        if csv_fn is None:
+            rng = np.random.default_rng(seed)
+            df = pd.DataFrame(rng.gamma(0.5, 20, size=(n_genes, n_samples)),
+                              index=[f'GENE{i} | ENSG{i:011d}.1' for i in range(n_genes)],
+                              columns=[f'SRR{i:07d}' for i in range(n_samples)])
+            csv_fn = os.path.join(tmp, 'matrix.csv')
+            df.to_csv(csv_fn)
+
+        t_csv, df = timeit(lambda: pd.read_csv(csv_fn, index_col=[0]), repeat=1)
+        store_fn = os.path.join(tmp, 'matrix.matrix')
+        t_save, store = timeit(lambda: MatrixStore.save(df, store_fn), repeat=1)
+
+        rng = np.random.default_rng(seed)
+        samples = list(rng.choice(df.columns, size=min(4, df.shape[1]), replace=False))
+        genes = list(rng.choice(df.index, size=min(1000, df.shape[0]), replace=False))
+        t_load, loaded = timeit(lambda: MatrixStore(store_fn).load())
+        t_cols, _ = timeit(lambda: MatrixStore(store_fn).load(columns=samples))
+        t_rows, _ = timeit(lambda: MatrixStore(store_fn).load(rows=genes))
+        t_csv_cols, _ = timeit(lambda: pd.read_csv(csv_fn, index_col=[0], usecols=[0] + [df.columns.get_loc(s)+1 for s in samples]), repeat=1)
+
+        size_csv = os.path.getsize(csv_fn)
+        size_store = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(store_fn) for f in files)
+        print(f'{df.shape[0]} rows x {df.shape[1]} columns')
+        print(f'size        : CSV {size_csv/1e6:.1f} MB, store {size_store/1e6:.1f} MB')
+        print(f'save store  : {t_save:.3f} s')
+        print(f'full load   : CSV {t_csv:.3f} s, store {t_load:.4f} s ({t_csv/t_load:.0f}x faster)')
+        print(f'{len(samples)} samples   : CSV {t_csv_cols:.3f} s, store {t_cols:.4f} s ({t_csv_cols/t_cols:.0f}x faster)')
+        print(f'{len(genes)} genes  : store {t_rows:.4f} s')
+        print(f'max difference to the CSV values (float32): {np.abs(loaded.values - df.values).max():.2e}')
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Compares the accuracy and the speed of the PAEA p value backends:
+# the closed form (incomplete beta) against the numerical integration of the null-distribution (trapz)
+# and runs paea on a characteristic direction of random data with both backends
+# usage: python benchmarks/bench_paea_pvalues.py [number of terms]
+
+import os, sys, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tools.signature import geode
+
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz # np.trapz was removed in numpy 2.4
+
+def reference_pval(theta, m, n, num=1000000):
+    """Numerical integration of the null-distribution with a much finer grid"""
+    m, n = float(m), float(n)
+    x = np.linspace(0, theta, num=num)
+    log_pac = np.log(2.*(1./np.sqrt(2*np.pi)))+(n/2.)*np.log(n/(n - m))+(m/2.)*np.log((n - m)/m)+(1/2.)*np.log(m/(2.*n)*(n - m))+(n-m-1)*np.log(np.sin(x))+(m-1)*np.log(np.cos(x))
+    return min(trapezoid(np.exp(log_pac), x), 1.)
+
+def main(n_terms=10000, n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    m = rng.integers(5, 500, size=n_terms)
+    # principal angles around the expected angle under the null, sqrt(m/n) = cos(theta)
+    theta = np.arccos(np.clip(np.sqrt(m/n) * rng.uniform(0.5, 4, size=n_terms), 0, 1))
+
+    ### Speed ###
+    start = time.perf_counter()
+    p_beta = geode._pac_pvals(theta, m, n)
+    t_beta = time.perf_counter() - start
+
+    start = time.perf_counter()
+    p_trapz = np.array([geode._pac_pval(t, k, n) for t, k in zip(theta, m)])
+    t_trapz = time.perf_counter() - start
+
+    print(f'{n_terms} terms, {n} genes')
+    print(f'beta : {t_beta:.4f} s')
+    print(f'trapz: {t_trapz:.4f} s ({t_trapz/t_beta:.0f}x slower)')
+
+    ### Accuracy on a subset of terms ###
+    subset = rng.choice(n_terms, size=min(n_terms, 50), replace=False)
+    p_ref = np.array([reference_pval(theta[i], m[i], n) for i in subset])
+    significant = p_ref > 1e-300
+    for name, p in [('beta', p_beta[subset]), ('trapz', p_trapz[subset])]:
+        rel_err = np.abs(p - p_ref)[significant] / p_ref[significant]
+        print(f'{name:5s} relative error to a 1e6 points integration: median {np.median(rel_err):.2e}, max {rel_err.max():.2e}')
+
+    ### paea on a characteristic direction, with both backends ###
+    genes = [f'GENE{i}' for i in range(2000)]
+    data = rng.normal(size=(len(genes), 12))
+    data[:50, 6:] += 2 # genes 0-49 up in the second group
+    chdir = geode.chdir(data, [1]*6 + [2]*6, genes, calculate_sig=False)
+    for name, gene_set in [('differential', genes[:50]), ('random', list(rng.choice(genes, 50, replace=False)))]:
+        (angle, p_beta), (_, p_trapz) = [geode.paea(chdir, gene_set, pval_method=method) for method in ('beta', 'trapz')]
+        print(f'paea {name:12s} gene set: principal angle {angle:.3f}, p value beta {p_beta:.3g}, trapz {p_trapz:.3g}')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Compares the startup time and peak memory of the PCA dashboard (Dash_PCA construction: data fingerprint, PCA,
+# top loadings and layout) with the full decomposition (all the components, as computed before the solvers were added)
+# and with the randomized and incremental solvers.
+# The data is loaded in memory beforehand for the full and randomized solvers (its size is reported separately from
+# the peak), the incremental solver reads it from the memory-mapped file.
+# usage: python benchmarks/bench_pca_dashboard.py [n_samples] [n_genes] [n_components]
+# a random log-expression matrix of 1000 samples x 60000 genes is used by default, memory-mapped from a temporary file
+
+import os, sys, time, tempfile, tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tools.pca_dashboard import Dash_PCA, MemoryStore
+
+def measure(f):
+    """Time and peak memory (numpy allocations included) of a call"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def main(n_samples=1000, n_genes=60000, n_components=20, seed=0):
+    n_samples, n_genes, n_components = int(n_samples), int(n_genes), int(n_components)
+    with tempfile.TemporaryDirectory() as tmp:
+        # low-rank structure (groups of samples) plus noise, written by chunks of samples
+        rng = np.random.default_rng(seed)
+        factors = rng.normal(size=(n_samples, 10)) * np.linspace(10, 1, 10)
+        loadings = rng.normal(size=(10, n_genes)) / np.sqrt(n_genes)
+        values = np.lib.format.open_memmap(os.path.join(tmp, 'data.npy'), mode='w+', dtype=np.float32,
+                                           shape=(n_samples, n_genes))
+        for start in range(0, n_samples, 100):
+            rows = slice(start, start+100)
+            values[rows] = factors[rows] @ loadings + rng.gamma(1, 1, size=(values[rows].shape[0], n_genes))
+        values.flush()
+        del values
+        values = np.load(os.path.join(tmp, 'data.npy'), mmap_mode='r')
+        samples = pd.Index([f'sample{i}' for i in range(n_samples)])
+        features = pd.Index(np.arange(n_genes).astype(str))
+        labels = pd.DataFrame({'group': pd.Series([f'group{i % 4}' for i in range(n_samples)], index=samples, dtype=object)})
+
+        print(f'{n_samples} samples x {n_genes} genes, {n_components} components')
+        results = {}
+        for name, solver, k in [('full (all components)', 'full', None), ('full', 'full', n_components),
+                                ('randomized', 'randomized', n_components), ('incremental', 'incremental', n_components)]:
+            # loaded in memory, except for incremental
+            matrix = values if solver == 'incremental' else np.array(values)
+            data = pd.DataFrame(matrix, index=samples, columns=features, copy=False)
+            # a new store for each dashboard, so that the PCA is computed at startup
+            elapsed, peak, app = measure(lambda: Dash_PCA(data, labels, store=MemoryStore(1), solver=solver, n_components=k))
+            results[name] = (app.projected_data.to_numpy(), app.variance_explained)
+            loaded = '' if solver == 'incremental' else f' (+ {matrix.nbytes/1e6:.0f} MB of data in memory)'
+            print(f'{name:22s}: startup {elapsed:7.2f} s, peak memory {peak/1e6:7.0f} MB{loaded}')
+            del app, data, matrix
+
+        reference = results['full (all components)']
+        for name, (projected, variance) in results.items():
+            correlations = [abs(np.corrcoef(projected[:, i], reference[0][:, i])[0, 1]) for i in range(3)]
+            print(f'{name:22s}: PC1-3 variance {np.round(variance[:3], 2)}, '
+                  f'min correlation with the full PCA {min(correlations):.4f}')
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
@@ -0,0 +1,205 @@
+### Gencode annotation index: transcript -> gene -> symbol lookups from the transcript FASTA headers ###
+
+import os, gzip
+import numpy as np
+import pandas as pd
+
+INDEX_VERSION = 1
+# fields of the Gencode transcript FASTA headers (and of the transcript names reported by salmon and kallisto)
+FIELDS = ['Tx', 'Gene', 'Havana gene', 'Havana tx', 'Tx name', 'Gene symbol', 'Length', 'Type']
+
+def strip_version(ids):
+    """Remove the version of ENSEMBL IDs (ENSG00000223972.5 -> ENSG00000223972), vectorised"""
+    return np.char.partition(np.asarray(ids).astype(str), '.')[:, 0]
+
+def _first_field(names):
+    """Transcript IDs of Gencode transcript names (ENST...|ENSG...|...), IDs without '|' are returned unchanged"""
+    return np.char.partition(np.asarray(names).astype(str), '|')[:, 0]
+
+def _lookup_table(ids):
+    """
+    Hashed lookup table of IDs: (pandas Index of the unique IDs, their positions in ids),
+    duplicated IDs (e.g. the X and PAR_Y copies of a gene once the version is removed) map to their first occurrence
+    """
+    index = pd.Index(ids)
+    keep = ~index.duplicated()
+    return index[keep], np.nonzero(keep)[0]
+
+
+class GencodeIndex():
+    """
+    Annotations of the transcripts of a Gencode release, integer-coded:
+        transcripts, tx_names, tx_types, tx_lengths: one entry per transcript
+        tx_gene: position of the gene of each transcript in genes
+        genes, gene_symbols: one entry per gene (versioned ENSEMBL IDs)
+
+    Build it once per release from the transcript FASTA file with GencodeIndex.load(fasta_fn), which saves it
+    as a .npz file next to the FASTA file and reloads it from there afterwards.
+    Lookups accept versioned or unversioned ENSEMBL IDs, or full Gencode transcript names, and are vectorised
+    with hash-based pandas indexes:
+
+        gencode = GencodeIndex.load('quant/gencode.v30.transcripts.fa.gz')
+        gencode.gene_of(target_ids)                  # transcript -> gene
+        gencode.symbol_of(['ENSG00000223972'])       # gene -> symbol
+        gencode.labels(genes)                        # 'symbol | gene' labels
+    """
+    _loaded = {} # indexes already loaded in this session, by path
+
+    def __init__(self, transcripts, tx_gene, tx_names, tx_types, tx_lengths, genes, gene_symbols, release=None):
+        self.transcripts = transcripts
+        self.tx_gene = tx_gene
+        self.tx_names = tx_names
+        self.tx_types = tx_types
+        self.tx_lengths = tx_lengths
+        self.genes = genes
+        self.gene_symbols = gene_symbols
+        self.release = release
+        self._lookups = {}
+
+    def __len__(self):
+        return len(self.transcripts)
+
+    def __repr__(self):
+        return f'GencodeIndex({self.release!r}, {len(self)} transcripts, {len(self.genes)} genes)'
+
+    @classmethod
+    def from_names(cls, names, release=None):
+        """Build the index from Gencode transcript names or FASTA headers (without '>')"""
+        fields = pd.Series(np.asarray(names).astype(str)).str.split('|', expand=True)
+        if fields.shape[1] < len(FIELDS):
+            raise ValueError('the transcript names are not Gencode transcript names')
+        fields = fields.iloc[:, :len(FIELDS)]
+        fields.columns = FIELDS
+        fields = {col: np.asarray(fields[col], dtype=str) for col in FIELDS}
+        genes, first, tx_gene = np.unique(fields['Gene'], return_index=True, return_inverse=True)
+        return cls(transcripts= fields['Tx'],
+                   tx_gene= tx_gene.astype(np.int32),
+                   tx_names= fields['Tx name'],
+                   tx_types= fields['Type'],
+                   tx_lengths= pd.to_numeric(pd.Series(fields['Length']), errors='coerce').fillna(-1).values.astype(np.int64),
+                   genes= genes,
+                   gene_symbols= fields['Gene symbol'][first],
+                   release= release)
+
+    @classmethod
+    def from_fasta(cls, fasta_fn, release=None):
+        """Build the index from the headers of a (gzipped) Gencode transcript FASTA file"""
+        opener = gzip.open if fasta_fn.endswith('.gz') else open
+        with opener(fasta_fn, 'rb') as f:
+            headers = [line[1:].rstrip().decode() for line in f if line.startswith(b'>')]
+        if release is None: # e.g. gencode.v30.transcripts.fa.gz
+            parts = os.path.basename(fasta_fn).split('.')
+            release = parts[1] if len(parts) > 1 and parts[0] == 'gencode' else None
+        return cls.from_names(headers, release=release)
+
+    @classmethod
+    def load(cls, fasta_fn, cache=True):
+        """
+        Load the index of a Gencode transcript FASTA file, from the index saved next to it (fasta_fn + '.index.npz')
+        if the FASTA file did not change, building and saving it otherwise
+        """
+        path = os.path.abspath(fasta_fn)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        loaded = cls._loaded.get(path)
+        if loaded is not None and loaded[0] == key:
+            return loaded[1]
+        index_fn = path + '.index.npz'
+        index = None
+        if cache and os.path.exists(index_fn):
+            try:
+                index = cls.read(index_fn, source=key)
+            except (OSError, ValueError, KeyError):
+                index = None
+        if index is None:
+            index = cls.from_fasta(path)
+            if cache:
+                index.save(index_fn, source=key)
+        cls._loaded[path] = (key, index)
+        return index
+
+    def save(self, index_fn, source=None):
+        """Save the index as a .npz file, source identifies the file the index was built from"""
+        tmp = index_fn + '.tmp.npz'
+        np.savez(tmp, transcripts=self.transcripts, tx_gene=self.tx_gene, tx_names=self.tx_names, tx_types=self.tx_types,
+                 tx_lengths=self.tx_lengths, genes=self.genes, gene_symbols=self.gene_symbols,
+                 meta=np.array([INDEX_VERSION, self.release or '', '' if source is None else '%d,%d' % source]))
+        os.replace(tmp, index_fn)
+
+    @classmethod
+    def read(cls, index_fn, source=None):
+        """Read an index saved with save, raises ValueError if it was built from another source"""
+        with np.load(index_fn) as data:
+            version, release, saved_source = data['meta'].tolist()
+            if int(version) != INDEX_VERSION or (source is not None and saved_source != '%d,%d' % source):
+                raise ValueError(f'{index_fn} is outdated')
+            arrays = {key: data[key] for key in ['transcripts', 'tx_gene', 'tx_names', 'tx_types', 'tx_lengths', 'genes', 'gene_symbols']}
+        return cls(release=release or None, **arrays)
+
+    #### lookups ####
+    def _positions(self, kind, ids):
+        """Positions of transcript ('tx') or gene ('gene') IDs, versioned or not, -1 for the IDs not found"""
+        ids = np.asarray(ids).astype(str)
+        if kind == 'tx':
+            ids = _first_field(ids)
+        versioned = np.char.find(ids, '.') >= 0
+        positions = np.full(len(ids), -1)
+        for with_version in (True, False):
+            selected = versioned == with_version
+            if not selected.any():
+                continue
+            key = (kind, with_version)
+            if key not in self._lookups:
+                reference = self.transcripts if kind == 'tx' else self.genes
+                self._lookups[key] = _lookup_table(reference if with_version else strip_version(reference))
+            index, reference_positions = self._lookups[key]
+            found = index.get_indexer(ids[selected])
+            positions[selected] = np.where(found >= 0, reference_positions[found], -1)
+        return positions
+
+    def gene_of(self, transcripts, version=True):
+        """Gene IDs of transcripts (IDs or Gencode names), None for unknown transcripts"""
+        positions = self._positions('tx', transcripts)
+        genes = self.genes if version else strip_version(self.genes)
+        return np.where(positions >= 0, genes[self.tx_gene[positions]], None)
+
+    def symbol_of(self, genes):
+        """Gene symbols of gene IDs (versioned or not), None for unknown genes"""
+        positions = self._positions('gene', genes)
+        return np.where(positions >= 0, self.gene_symbols[positions], None)
+
+    def tx_symbol_of(self, transcripts):
+        """Gene symbols of transcripts (IDs or Gencode names), None for unknown transcripts"""
+        positions = self._positions('tx', transcripts)
+        return np.where(positions >= 0, self.gene_symbols[self.tx_gene[positions]], None)
+
+    def labels(self, genes):
+        """'symbol | gene' labels of gene IDs, as used for the gene expression matrices"""
+        genes = np.asarray(genes).astype(str)
+        symbols = self.symbol_of(genes)
+        symbols = np.where(symbols == None, genes, symbols).astype(str)
+        return np.char.add(np.char.add(symbols, ' | '), genes)
+
+    #### tables ####
+    def annotate(self, transcripts):
+        """DataFrame of the Gencode annotations of transcripts (IDs or Gencode names), in the same order"""
+        positions = self._positions('tx', transcripts)
+        if (positions < 0).any():
+            raise KeyError(f'{(positions < 0).sum()} transcripts not found in the Gencode index {self.release}')
+        gene_positions = self.tx_gene[positions]
+        return pd.DataFrame({'Tx': self.transcripts[positions], 'Gene': self.genes[gene_positions],
+                             'Tx name': self.tx_names[positions], 'Gene symbol': self.gene_symbols[gene_positions],
+                             'Length': self.tx_lengths[positions], 'Type': self.tx_types[positions]})
+
+    def tx2gene(self):
+        """Transcript to gene table (Tx, Gene), as expected by tximport"""
+        return pd.DataFrame({'Tx': self.transcripts, 'Gene': self.genes[self.tx_gene]})
+
+    def gene_info(self):
+        """Gene to symbol table (Gene, Gene symbol), sorted by gene"""
+        return pd.DataFrame({'Gene': self.genes, 'Gene symbol': self.gene_symbols})
+
+    def ttg(self, target_ids):
+        """Transcript to gene table of kallisto target IDs, as expected by sleuth (target_id, ens_gene, ext_gene)"""
+        return pd.DataFrame({'target_id': np.asarray(target_ids), 'ens_gene': self.gene_of(target_ids),
+                             'ext_gene': self.tx_symbol_of(target_ids)})
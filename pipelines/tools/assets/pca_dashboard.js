@@ -0,0 +1,46 @@
+// Clientside callbacks of the PCA dashboard (tools/pca_dashboard.py)
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    pca_dashboard: {
+        // Scattergl figure of the large data mode, assembled in the browser from the points plotted
+        // (scatter_points store) and the colour of every sample (scatter_colors store), so that changing
+        // the colours only sends the colours from the server
+        scatter_figure: function(points, colors) {
+            if (!points || !colors) {
+                return {'data': [], 'layout': {}};
+            }
+            var marker = {
+                'size': 6,
+                'opacity': .8,
+                'color': points.index.map(function(i) { return colors.color[i]; }),
+                'colorscale': colors.colorscale,
+                'showscale': true,
+                'colorbar': {'len': 0.5, 'title': colors.name}
+            };
+            if (colors.ticktext) {
+                marker.cmin = -0.5;
+                marker.cmax = colors.ticktext.length - 0.5;
+                marker.colorbar.tickvals = colors.ticktext.map(function(t, i) { return i; });
+                marker.colorbar.ticktext = colors.ticktext;
+            }
+            return {
+                'data': [{
+                    'type': 'scattergl',
+                    'mode': 'markers',
+                    'x': points.x,
+                    'y': points.y,
+                    'text': points.text,
+                    'customdata': points.index,
+                    'hoverinfo': 'text',
+                    'marker': marker
+                }],
+                'layout': {
+                    'title': 'PCA (' + points.shown + ' of ' + points.n + ' samples)',
+                    'xaxis': {'title': points.xtitle},
+                    'yaxis': {'title': points.ytitle},
+                    'clickmode': 'event+select',
+                    'uirevision': points.revision
+                }
+            };
+        }
+    }
+});
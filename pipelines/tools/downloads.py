@@ -0,0 +1,344 @@
+### Parallel, resumable downloads (http(s) and ftp) ###
+
+import os, hashlib, ftplib, socket, threading, queue
+import socketserver
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+def _md5(filename, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def _finalize(part, local_filename, size=None, md5=None):
+    """Check the size and checksum of a downloaded file before moving it to its final name"""
+    if size is not None and os.path.getsize(part) != size:
+        raise IOError(f'{local_filename}: downloaded {os.path.getsize(part)} bytes, expected {size}')
+    if md5 is not None and _md5(part) != md5.lower():
+        os.remove(part) # corrupted, restart from scratch next time
+        raise IOError(f'{local_filename}: md5 checksum mismatch')
+    os.replace(part, local_filename)
+    return local_filename
+
+def _remote_size(response, url, session):
+    """Size of the remote file of a 416 response, from its Content-Range (bytes */size) or from a HEAD request"""
+    content_range = response.headers.get('content-range', '')
+    if content_range.startswith('bytes */'):
+        return int(content_range[len('bytes */'):])
+    head = session.head(url, allow_redirects=True, timeout=60)
+    head.raise_for_status()
+    length = head.headers.get('content-length')
+    return int(length) if length is not None else None
+
+def download_http(url, local_filename, session=None, md5=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Download a file over http(s), resuming a previous partial download if there is one.
+    The data is written to local_filename + '.part' which is renamed once the size (and md5 if provided) is checked,
+    so that an interrupted download is never mistaken for a complete file.
+
+    progress: optional callable progress(total_size) returning a callable called with the size of each chunk written
+    """
+    session = session or requests
+    part = local_filename + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with session.get(url, stream=True, headers=headers, timeout=60) as response:
+        if response.status_code == 416: # nothing left to download: the partial file is complete, or is not the remote file
+            size = _remote_size(response, url, session)
+            if size is None or size != offset:
+                os.remove(part) # restart from scratch next time
+                raise IOError(f'{local_filename}: partial file of {offset} bytes, remote file of {size} bytes')
+            return _finalize(part, local_filename, size=size, md5=md5)
+        response.raise_for_status()
+        if response.status_code != 206: # the server ignored the range, start again
+            offset = 0
+        length = response.headers.get('content-length')
+        size = offset + int(length) if length is not None else None
+        update = progress(size) if progress is not None and size is not None else None
+        if update is not None and offset:
+            update(offset)
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                if update is not None:
+                    update(len(chunk))
+    return _finalize(part, local_filename, size=size, md5=md5)
+
+
+class FTPPool():
+    """A pool of logged-in ftp sessions to a host, reused across downloads"""
+    def __init__(self, host, user='', passwd='', port=21, timeout=60):
+        self.host, self.user, self.passwd, self.port, self.timeout = host, user, passwd, port, timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.passwd)
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def _checkout(self):
+        """An idle session still connected (servers drop idle sessions), or a new session"""
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except (ftplib.Error, OSError, EOFError):
+                ftp.close()
+
+    @contextmanager
+    def connection(self):
+        ftp = self._checkout()
+        try:
+            yield ftp
+        except (ftplib.Error, OSError, EOFError):
+            # drop the session, it may be in an inconsistent state
+            ftp.close()
+            raise
+        self._idle.put(ftp)
+
+    def close(self):
+        while not self._idle.empty():
+            ftp = self._idle.get_nowait()
+            try:
+                ftp.quit()
+            except (ftplib.Error, OSError, EOFError):
+                ftp.close()
+
+_ftp_pools = {}
+_ftp_pools_lock = threading.Lock()
+
+def get_ftp_pool(host, port=21, user='', passwd=''):
+    """Return the shared pool of sessions of an ftp host"""
+    with _ftp_pools_lock:
+        key = (host, port, user)
+        if key not in _ftp_pools:
+            _ftp_pools[key] = FTPPool(host, user=user, passwd=passwd, port=port)
+        return _ftp_pools[key]
+
+def download_ftp(pool, path_to_remote_file, local_filename, md5=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Download a file over ftp with a session of an FTPPool, resuming a previous partial download (REST) if there is one.
+    See download_http for the handling of partial files and of the progress callback.
+    A transfer failing on a connection error is retried once on a new session, resuming where it stopped.
+    """
+    try:
+        return _download_ftp(pool, path_to_remote_file, local_filename, md5=md5, chunk_size=chunk_size, progress=progress)
+    except (ftplib.error_temp, ftplib.error_reply, ConnectionError, TimeoutError, EOFError):
+        # the failed session was dropped from the pool
+        return _download_ftp(pool, path_to_remote_file, local_filename, md5=md5, chunk_size=chunk_size, progress=progress)
+
+def _download_ftp(pool, path_to_remote_file, local_filename, md5=None, chunk_size=CHUNK_SIZE, progress=None):
+    part = local_filename + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    with pool.connection() as ftp:
+        size = ftp.size(path_to_remote_file)
+        if size is not None and offset > size:
+            offset = 0
+        update = progress(size) if progress is not None and size is not None else None
+        if update is not None and offset:
+            update(offset)
+        if size is None or offset < size:
+            with open(part, 'ab' if offset else 'wb') as f:
+                def callback(chunk):
+                    f.write(chunk)
+                    if update is not None:
+                        update(len(chunk))
+                ftp.retrbinary('RETR ' + path_to_remote_file, callback, blocksize=chunk_size, rest=offset or None)
+    return _finalize(part, local_filename, size=size, md5=md5)
+
+
+class DownloadManager():
+    """
+    Download many files concurrently, with resume, retries, size and checksum checks, and pooled connections.
+
+        manager = DownloadManager(max_connections=8)
+        manager.download_all([(url, local_filename), ...])
+
+    max_connections: number of parallel downloads
+    retries: number of attempts per file, each attempt resuming the previous one
+    """
+    def __init__(self, max_connections=4, retries=3, chunk_size=CHUNK_SIZE):
+        self.max_connections = max_connections
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url, local_filename, md5=None, progress=None):
+        """Download one file, returns 'skipped' if it already exists, 'downloaded' otherwise"""
+        if os.path.exists(local_filename):
+            return 'skipped'
+        parsed = urlparse(url)
+        for attempt in range(self.retries):
+            try:
+                if parsed.scheme == 'ftp':
+                    pool = get_ftp_pool(parsed.hostname, port=parsed.port or 21, user=parsed.username or '', passwd=parsed.password or '')
+                    download_ftp(pool, parsed.path.lstrip('/'), local_filename, md5=md5, chunk_size=self.chunk_size, progress=progress)
+                else:
+                    download_http(url, local_filename, session=self.session, md5=md5, chunk_size=self.chunk_size, progress=progress)
+                return 'downloaded'
+            except (requests.RequestException, ftplib.Error, OSError, EOFError) as e:
+                if attempt == self.retries - 1:
+                    raise
+                print(f'{local_filename}: {e}, retrying')
+
+    def download_all(self, downloads):
+        """
+        Download files concurrently
+
+        downloads: list of tuples (url, local_filename) or (url, local_filename, md5)
+        Returns a dict {local_filename: 'downloaded', 'skipped' or the exception raised}
+        """
+        def job(item):
+            try:
+                return self.download(*item)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            status = list(executor.map(job, downloads))
+        for item, s in zip(downloads, status):
+            print(f'{item[1]}: {s}')
+        return {item[1]: s for item, s in zip(downloads, status)}
+
+def download_sra_runs(sra_run_info, outdir, max_connections=4):
+    """Download the sra files of all runs of a SraRunInfo table (download_path column) to outdir/<run>.sra"""
+    downloads = [(url, os.path.join(outdir, url.split('/')[-1] + '.sra')) for url in sra_run_info.download_path]
+    return DownloadManager(max_connections=max_connections).download_all(downloads)
+
+
+#### local stand-ins to test downloads ####
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler supporting single byte range requests"""
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self._range = None
+        byte_range = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if byte_range is None or not byte_range.startswith('bytes=') or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, end = byte_range[len('bytes='):].split('-')
+        start, end = int(start), int(end) if end else size - 1
+        if start >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        end = min(end, size - 1)
+        f = open(path, 'rb')
+        f.seek(start)
+        self._range = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(self._range))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self._range is None:
+            return super().copyfile(source, outputfile)
+        remaining = self._range
+        while remaining > 0:
+            block = source.read(min(remaining, 64*1024))
+            if not block:
+                break
+            outputfile.write(block)
+            remaining -= len(block)
+
+class _FTPHandler(socketserver.StreamRequestHandler):
+    """Minimal read-only anonymous ftp server: USER, PASS, TYPE, SIZE, PASV, REST, RETR, NOOP, QUIT"""
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        root = self.server.directory
+        rest, data_sock = 0, None
+        self.reply('220 ready')
+        for line in self.rfile:
+            cmd, _, arg = line.decode().strip().partition(' ')
+            cmd = cmd.upper()
+            path = os.path.join(root, arg.lstrip('/'))
+            if cmd == 'USER':
+                self.reply('331 password required')
+            elif cmd in ('PASS', 'TYPE', 'NOOP'):
+                self.reply('230 ok' if cmd == 'PASS' else '200 ok')
+            elif cmd == 'SIZE':
+                self.reply(f'213 {os.path.getsize(path)}' if os.path.isfile(path) else '550 not found')
+            elif cmd == 'REST':
+                rest = int(arg)
+                self.reply('350 restarting')
+            elif cmd == 'PASV':
+                data_sock = socket.socket()
+                data_sock.bind((self.server.server_address[0], 0))
+                data_sock.listen(1)
+                host, port = data_sock.getsockname()
+                self.reply('227 Entering Passive Mode (%s,%d,%d)' % (host.replace('.', ','), port >> 8, port & 255))
+            elif cmd == 'RETR':
+                if not os.path.isfile(path) or data_sock is None:
+                    self.reply('550 not found')
+                    continue
+                self.reply('150 opening data connection')
+                conn, _ = data_sock.accept()
+                with conn, open(path, 'rb') as f:
+                    f.seek(rest)
+                    for block in iter(lambda: f.read(64*1024), b''):
+                        conn.sendall(block)
+                data_sock.close()
+                rest, data_sock = 0, None
+                self.reply('226 transfer complete')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('502 not implemented')
+
+class LocalFileServer():
+    """
+    Serve a directory over http (with range requests) or ftp (with REST) on localhost, in a background thread
+
+        server = LocalFileServer(directory, protocol='ftp').start()
+        DownloadManager().download_all([(server.url + '/file.sra', 'file.sra')])
+        server.stop()
+    """
+    def __init__(self, directory, protocol='http', host='127.0.0.1', port=0):
+        if protocol == 'http':
+            handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=directory, **kwargs)
+            self.server = ThreadingHTTPServer((host, port), handler)
+        elif protocol == 'ftp':
+            self.server = socketserver.ThreadingTCPServer((host, port), _FTPHandler)
+            self.server.daemon_threads = True
+            self.server.directory = directory
+        else:
+            raise ValueError("protocol has to be either 'http' or 'ftp'")
+        self.url = '%s://%s:%s' % ((protocol,) + self.server.server_address[:2])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
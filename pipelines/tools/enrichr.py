@@ -1,7 +1,10 @@
 # utils for RNAseq
-import json
-from time import sleep
+import os, json, hashlib, threading
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 ENRICHR_URL = 'http://amp.pharm.mssm.edu/Enrichr'
 
@@ -53,4 +56,117 @@ def enrichr_term_score(genes, meta='', gmt=''):
 		term = res[1]
 		combined_score = res[4]
 		terms_scores.append((term, combined_score))
-	return terms_scores
\ No newline at end of file
+	return terms_scores
+
+
+class EnrichrClient():
+	"""
+	Enrichr client keeping a pooled session, polling results with backoff and caching responses on disk.
+	Gene lists and libraries can be submitted concurrently:
+
+		client = EnrichrClient()
+		links = client.links([up_genes, dn_genes], ['up', 'down'])
+		results = client.results([up_genes, dn_genes], ['KEGG_2019_Human', 'GO_Biological_Process_2018'])
+
+	url: url of the Enrichr API (e.g. the url of a tools.enrichr_local.LocalEnrichrServer to test offline)
+	cache_dir: directory in which responses are cached, keyed by the hash of the gene list (and library), None to disable
+	max_workers: maximum number of concurrent requests
+	retries: number of retries of failed connections and of GET requests failing with 429/5xx responses or timeouts,
+	         with exponential backoff
+	max_wait: maximum time (s) to wait for the results of a list to be ready
+	"""
+	def __init__(self, url=None, cache_dir='data/enrichr_cache', max_workers=8, retries=5, timeout=60, max_wait=60):
+		self.url = url or ENRICHR_URL
+		self.cache_dir = cache_dir
+		self.max_workers = max_workers
+		self.timeout = timeout
+		self.max_wait = max_wait
+		self.session = requests.Session()
+		# POST /addList is not idempotent: it is only retried on connection errors (urllib3 retries them for any method)
+		retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+					  allowed_methods=frozenset(['GET']))
+		adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		if cache_dir is not None:
+			os.makedirs(cache_dir, exist_ok=True)
+		self._list_ids = {} # ids of the lists added by this client, so that a list is added once even without cache
+		self._list_locks = {}
+		self._lock = threading.Lock()
+
+	def _cached(self, key, fetch):
+		"""Return the cached response for key, or fetch it and cache it"""
+		if self.cache_dir is None:
+			return fetch()
+		path = os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+		if os.path.exists(path):
+			with open(path) as f:
+				return json.load(f)
+		response = fetch()
+		tmp = '%s.%s.tmp' % (path, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump(response, f)
+		os.replace(tmp, path)
+		return response
+
+	def add_list(self, genes, meta=''):
+		"""POST a gene list to Enrichr server and return the list ids"""
+		def fetch():
+			payload = {
+				'list': (None, '\n'.join(genes)),
+				'description': (None, meta)
+			}
+			response = self.session.post('%s/addList' % self.url, files=payload, timeout=self.timeout)
+			response.raise_for_status()
+			return response.json()
+		key = '\n'.join(['addList', self.url, meta] + list(genes))
+		with self._lock:
+			list_lock = self._list_locks.setdefault(key, threading.Lock())
+		with list_lock:
+			if key not in self._list_ids:
+				self._list_ids[key] = self._cached(key, fetch)
+			return self._list_ids[key]
+
+	def link(self, genes, meta=''):
+		"""POST a gene list to Enrichr server and get the link."""
+		return '%s/enrich?dataset=%s' % (self.url, self.add_list(genes, meta)['shortId'])
+
+	def result(self, genes, gmt, meta=''):
+		"""Return the enrichment results of a gene list for a specific gene-set library on Enrichr"""
+		def fetch():
+			list_ids = self.add_list(genes, meta)
+			url = '%s/enrich?userListId=%s&backgroundType=%s' % (self.url, list_ids['userListId'], gmt)
+			# poll until the results are ready instead of waiting a fixed time
+			delay, deadline = 0.25, monotonic() + self.max_wait
+			while True:
+				response = self.session.get(url, timeout=self.timeout)
+				if response.status_code == 200 and gmt in response.json():
+					return response.json()[gmt]
+				if monotonic() + delay > deadline:
+					raise Exception('HTTP reponse code=%s' % response.status_code)
+				sleep(delay)
+				delay = min(delay * 2, 8)
+		# results do not depend on the order of the genes
+		return self._cached('\n'.join(['enrich', self.url, gmt] + sorted(set(genes))), fetch)
+
+	def term_score(self, genes, gmt, meta=''):
+		"""Only get terms and combined scores"""
+		return [(res[1], res[4]) for res in self.result(genes, gmt, meta)]
+
+	def _map(self, func, *iterables):
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			return list(executor.map(func, *iterables))
+
+	def links(self, gene_lists, metas=None):
+		"""Get the links of many gene lists concurrently"""
+		metas = metas or [''] * len(gene_lists)
+		return self._map(self.link, gene_lists, metas)
+
+	def results(self, gene_lists, gmts, metas=None):
+		"""Get the results of many gene lists for many libraries concurrently, returns a list of dicts {gmt: results}"""
+		metas = metas or [''] * len(gene_lists)
+		# register all lists first so that each list is only added once
+		self._map(self.add_list, gene_lists, metas)
+		jobs = [(genes, gmt, meta) for genes, meta in zip(gene_lists, metas) for gmt in gmts]
+		results = self._map(lambda job: self.result(*job), jobs)
+		return [dict(zip(gmts, results[i*len(gmts):(i+1)*len(gmts)])) for i in range(len(gene_lists))]
@@ -0,0 +1,246 @@
+# Offline equivalent of the Enrichr API using locally stored GMT libraries
+import os, json, uuid, threading, itertools
+import email.parser, email.policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.special import gammaln
+from tools.genesets import GeneSetLibrary
+
+# directory containing the gene-set libraries, stored as <library name>.gmt
+LIBRARY_DIR = os.environ.get('ENRICHR_LIBRARY_DIR', 'data/enrichr_libraries')
+
+def load_library(gmt):
+	"""Load a local gene-set library by its Enrichr name"""
+	return GeneSetLibrary.load(os.path.join(LIBRARY_DIR, '%s.gmt' % gmt))
+
+
+def _benjamini_hochberg(p_vals):
+	"""Benjamini-Hochberg adjusted p values along the first axis"""
+	n = p_vals.shape[0]
+	order = np.argsort(p_vals, axis=0)
+	ranked = np.take_along_axis(p_vals, order, axis=0) * n / np.arange(1, n+1)[:, None]
+	ranked = np.minimum.accumulate(ranked[::-1], axis=0)[::-1]
+	adj_p = np.empty_like(p_vals)
+	np.put_along_axis(adj_p, order, np.minimum(ranked, 1.), axis=0)
+	return adj_p
+
+
+def _log_binom(a, b):
+	return gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
+
+
+def _hypergeom_sf(k, N, K, n, block=32):
+	"""
+	P(X >= k) for X following the hypergeometric distribution of n draws among N genes of which K are in the term,
+	vectorised over all (term, list) pairs by summing the probability mass function over the tail, block by block,
+	until the remaining terms past the mode are negligible
+	"""
+	shape = np.broadcast(k, K, n).shape
+	k, K, n = [a.ravel().astype(float) for a in np.broadcast_arrays(k, K, n)]
+	p_vals = np.ones(k.size) # P(X >= 0) = 1
+	upper = np.minimum(K, n)
+	start = np.maximum(k, n - (N - K)) # the pmf is null below n - (N - K)
+	mode = np.floor((n + 1) * (K + 1) / (N + 2))
+	p_vals[k > upper] = 0.
+	active = np.nonzero((k > 0) & (k <= upper))[0]
+	p_vals[active] = 0.
+	offset = 0
+	while len(active):
+		x = start[active, None] + offset + np.arange(block)[None, :]
+		valid = x <= upper[active, None]
+		x = np.where(valid, x, upper[active, None])
+		KK, nn = K[active, None], n[active, None]
+		logpmf = _log_binom(KK, x) + _log_binom(N - KK, nn - x) - _log_binom(N, nn)
+		pmf = np.where(valid, np.exp(logpmf), 0.)
+		p_vals[active] += pmf.sum(axis=1)
+		last = start[active] + offset + block - 1
+		done = (last >= upper[active]) | ((last >= mode[active]) & (pmf[:, -1] <= 1e-17 * p_vals[active]))
+		active = active[~done]
+		offset += block
+	return np.minimum(p_vals, 1.).reshape(shape)
+
+
+def enrich_library(gene_lists, library, background=None):
+	"""
+	Score all the terms of a library for many gene lists at once
+
+	gene_lists: list of gene lists
+	library: GeneSetLibrary
+	background: size of the background, defaults to the number of genes in the library
+	Returns a list (one per gene list) of results formatted as the Enrichr API:
+		[rank, term, p value, z-score, combined score, overlapping genes, adjusted p value, 0, 0]
+	where the z-score is the standardized overlap with the term under the hypergeometric distribution
+	and the combined score is -ln(p value) * z-score
+	"""
+	# genes are matched case-insensitively, as done by Enrichr
+	vocabulary, canonical = np.unique(np.char.upper(np.asarray(library.genes).astype(str)), return_inverse=True)
+	gene_ids = canonical[library.gene_ids]
+	gene_index = {gene: i for i, gene in enumerate(vocabulary)}
+	n_genes = len(vocabulary)
+	N = n_genes if background is None else background
+
+	# list x gene and term x gene indicator matrices
+	lists = [np.unique([gene_index[g] for g in map(str.upper, genes) if g in gene_index]).astype(int) for genes in gene_lists]
+	rows = np.repeat(np.arange(len(lists)), [len(ids) for ids in lists])
+	Q = csr_matrix((np.ones(len(rows)), (rows, np.concatenate(lists + [np.zeros(0, dtype=int)]))), shape=(len(lists), n_genes))
+	term_rows = np.repeat(np.arange(len(library)), np.diff(library.offsets))
+	M = csr_matrix((np.ones(len(term_rows)), (term_rows, gene_ids)), shape=(len(library), n_genes))
+	M.data[:] = 1.
+
+	# hypergeometric test of all terms x lists
+	k = np.asarray(M.dot(Q.T).todense()) # overlaps
+	K = np.asarray(M.sum(axis=1)) # term sizes
+	n = np.array([len(ids) for ids in lists])[None, :] # list sizes
+	p_vals = _hypergeom_sf(k, N, K, n)
+	expected = n * K / N
+	std = np.sqrt(expected * (N - K) / N * (N - n) / max(N - 1, 1))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		z_scores = np.where(std > 0, (k - expected) / std, 0.)
+	combined_scores = -np.log(np.maximum(p_vals, np.finfo(float).tiny)) * z_scores
+	adj_p_vals = _benjamini_hochberg(p_vals)
+
+	term_names = np.asarray(library.terms).tolist()
+	gene_offsets = np.asarray(library.offsets)
+	results = []
+	for l, ids in enumerate(lists):
+		terms = np.nonzero(k[:, l])[0]
+		terms = terms[np.argsort(p_vals[terms, l], kind='stable')]
+		# overlapping genes of every term, from the library genes found in the list
+		in_list = np.zeros(n_genes, dtype=bool)
+		in_list[ids] = True
+		hits = np.nonzero(in_list[gene_ids])[0]
+		hit_terms = np.searchsorted(gene_offsets, hits, side='right') - 1
+		pairs = np.unique(hit_terms.astype(np.int64) * n_genes + gene_ids[hits])
+		bounds = np.searchsorted(pairs // n_genes, np.arange(len(library)+1))
+		overlaps = vocabulary[pairs % n_genes].tolist()
+		columns = [p_vals[terms, l].tolist(), z_scores[terms, l].tolist(), combined_scores[terms, l].tolist(), adj_p_vals[terms, l].tolist()]
+		results.append([[rank+1, term_names[t], p, z, c, overlaps[bounds[t]:bounds[t+1]], adj_p, 0, 0]
+						for rank, (t, p, z, c, adj_p) in enumerate(zip(terms.tolist(), *columns))])
+	return results
+
+
+def enrich(gene_lists, gmts):
+	"""Score many gene lists against many local libraries, returns {gmt: list of results (one per gene list)}"""
+	return {gmt: enrich_library(gene_lists, load_library(gmt)) for gmt in gmts}
+
+
+#### same signatures as tools.enrichr ####
+_lists = {} # gene lists added locally, by userListId
+_list_ids = itertools.count(1)
+_lists_lock = threading.Lock() # lists can be added concurrently by the threads of LocalEnrichrServer
+LOCAL_URL = 'http://127.0.0.1:5000/Enrichr' # url of the stand-in server, see LocalEnrichrServer
+
+def _enrichr_add_list(genes, meta=''):
+	"""Store a gene list locally and return the list ids"""
+	with _lists_lock:
+		list_ids = {'shortId': uuid.uuid4().hex[:12], 'userListId': next(_list_ids)}
+		_lists[list_ids['userListId']] = {'genes': list(genes), 'description': meta, 'shortId': list_ids['shortId']}
+	return list_ids
+
+
+def enrichr_link(genes, meta=''):
+	"""Store a gene list locally and get the link to its results on the stand-in server."""
+	list_ids = _enrichr_add_list(genes, meta)
+	return '%s/enrich?dataset=%s' % (LOCAL_URL, list_ids['shortId'])
+
+
+def enrichr_result(genes, meta='', gmt=''):
+	"""Return the enrichment results for a specific local gene-set library, formatted as Enrichr"""
+	return {gmt: enrich([genes], [gmt])[gmt][0]}
+
+
+def enrichr_term_score(genes, meta='', gmt=''):
+	"""Only get terms and scores"""
+	results = enrichr_result(genes, meta=meta, gmt=gmt)[gmt]
+	return [(res[1], res[4]) for res in results]
+
+
+#### local HTTP stand-in for the Enrichr API ####
+class _EnrichrHandler(BaseHTTPRequestHandler):
+
+	def log_message(self, format, *args):
+		pass
+
+	def _send_json(self, obj, status=200):
+		body = json.dumps(obj).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _form(self):
+		"""Parse a multipart or urlencoded form"""
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		content_type = self.headers.get('Content-Type', '')
+		if content_type.startswith('multipart/form-data'):
+			message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+				b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+			form = {}
+			for part in message.iter_parts():
+				value = part.get_payload(decode=True) or b''
+				form[part.get_param('name', header='content-disposition')] = value.decode()
+			return form
+		return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+	def do_POST(self):
+		path = urlparse(self.path).path
+		if path.endswith('/addList'):
+			form = self._form()
+			genes = [gene.strip() for gene in form.get('list', '').split('\n') if gene.strip()]
+			self._send_json(_enrichr_add_list(genes, form.get('description', '')))
+		else:
+			self._send_json({'error': 'not found'}, 404)
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		query = {key: values[0] for key, values in parse_qs(url.query).items()}
+		if url.path.endswith('/enrich') and 'userListId' in query:
+			user_list = _lists.get(int(query['userListId']))
+			gmt = query.get('backgroundType', '')
+			if user_list is None or not os.path.exists(os.path.join(LIBRARY_DIR, '%s.gmt' % gmt)):
+				return self._send_json({'error': 'not found'}, 404)
+			self._send_json(enrichr_result(user_list['genes'], gmt=gmt))
+		elif url.path.endswith('/enrich') and 'dataset' in query:
+			user_list = [l for l in _lists.values() if l['shortId'] == query['dataset']]
+			if not user_list:
+				return self._send_json({'error': 'not found'}, 404)
+			gmts = sorted(f[:-4] for f in os.listdir(LIBRARY_DIR) if f.endswith('.gmt'))
+			results = enrich([user_list[0]['genes']], gmts)
+			self._send_json({gmt: results[gmt][0] for gmt in gmts})
+		elif url.path.endswith('/view') and 'userListId' in query:
+			user_list = _lists.get(int(query['userListId']))
+			if user_list is None:
+				return self._send_json({'error': 'not found'}, 404)
+			self._send_json({'genes': user_list['genes'], 'description': user_list['description']})
+		else:
+			self._send_json({'error': 'not found'}, 404)
+
+
+class LocalEnrichrServer():
+	"""
+	Local HTTP stand-in for the Enrichr API (/addList, /enrich and /view endpoints) backed by the local scorer.
+	Point tools.enrichr at it to test it against the remote API or to work offline:
+		server = LocalEnrichrServer().start()
+		enrichr.ENRICHR_URL = server.url
+		...
+		server.stop()
+	"""
+	def __init__(self, host='127.0.0.1', port=0):
+		self.httpd = ThreadingHTTPServer((host, port), _EnrichrHandler)
+		self.url = 'http://%s:%s/Enrichr' % self.httpd.server_address[:2]
+		self.thread = None
+
+	def start(self):
+		global LOCAL_URL
+		LOCAL_URL = self.url
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		self.thread.join()
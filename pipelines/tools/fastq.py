@@ -0,0 +1,242 @@
+### Streaming of sra files to compressed fastq files ###
+
+import os, json, shutil, struct, zlib, gzip, shlex
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+
+N_CPU = os.cpu_count()
+BGZF_BLOCK_SIZE = 65280 # maximum uncompressed size of a BGZF block
+LAYOUT_SUFFIX = '.layout.json' # file recording the layout detected by dump_compressed, next to the fastq files
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def _gzip_member(data, level):
+    """Compress data as an independent gzip member"""
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+def _bgzf_blocks(data, level):
+    """Compress data as a series of BGZF blocks (gzip members with the block size in an extra field)"""
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[start:start+BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+        blocks.append(header + deflated + struct.pack('<II', zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+
+class ParallelGzipWriter():
+    """
+    File-like object compressing the data written to it in blocks compressed in parallel by a thread pool
+    (zlib releases the GIL). The output is a multi-member gzip file readable by gzip, salmon, kallisto and fastqc,
+    or a BGZF file (bgzf=True) which can also be indexed.
+
+    level: compression level (1-9)
+    threads: number of compression threads
+    block_size: size of the uncompressed blocks compressed by each thread
+    """
+    def __init__(self, path, level=6, threads=N_CPU, bgzf=False, block_size=4*1024*1024):
+        self.path = path
+        self.level = level
+        self.compress = _bgzf_blocks if bgzf else _gzip_member
+        self.bgzf = bgzf
+        self.block_size = block_size
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = []
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        if self.buffered:
+            self.pending.append(self.executor.submit(self.compress, b''.join(self.buffer), self.level))
+            self.buffer, self.buffered = [], 0
+        # write the compressed blocks in order, bounding the number of blocks in memory
+        while self.pending and (len(self.pending) >= self.max_pending or self.pending[0].done()):
+            self.file.write(self.pending.pop(0).result())
+
+    def close(self):
+        self._submit()
+        for future in self.pending:
+            self.file.write(future.result())
+        self.pending = []
+        if self.bgzf:
+            self.file.write(BGZF_EOF)
+        self.executor.shutdown()
+        self.file.close()
+
+    def abort(self):
+        """Stop compressing and close the file, leaving it incomplete (it is to be deleted)"""
+        for future in self.pending:
+            future.cancel()
+        self.pending, self.buffer, self.buffered = [], [], 0
+        self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _PipeWriter():
+    """File-like object writing to an external compressor (pigz or bgzip)"""
+    def __init__(self, path, command):
+        self.file = open(path, 'wb')
+        self.process = sp.Popen(command, stdin=sp.PIPE, stdout=self.file)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.file.close()
+        if returncode != 0:
+            raise sp.CalledProcessError(returncode, self.process.args)
+
+    def abort(self):
+        """Stop the compressor and close the file, leaving it incomplete (it is to be deleted)"""
+        self.process.kill()
+        try:
+            self.process.stdin.close()
+        except OSError: # broken pipe
+            pass
+        self.process.wait()
+        self.file.close()
+
+
+def open_compressed(path, level=6, threads=N_CPU, compressor='auto'):
+    """
+    Open a file for writing compressed data
+
+    compressor: 'pigz' (parallel gzip), 'bgzip' (parallel BGZF), 'python' (ParallelGzipWriter), 'python-bgzf'
+                or 'auto' to use pigz if it is installed and ParallelGzipWriter otherwise
+    """
+    if compressor == 'auto':
+        compressor = 'pigz' if shutil.which('pigz') else 'python'
+    if compressor == 'pigz':
+        return _PipeWriter(path, ['pigz', f'-{level}', '-p', str(threads), '-c'])
+    if compressor == 'bgzip':
+        return _PipeWriter(path, ['bgzip', '-l', str(level), '-@', str(threads), '-c'])
+    if compressor in ('python', 'python-bgzf'):
+        return ParallelGzipWriter(path, level=level, threads=threads, bgzf=compressor == 'python-bgzf')
+    raise ValueError(f'unknown compressor {compressor}')
+
+
+def dump_compressed(sra, outdir, threads=N_CPU, level=6, compressor='auto', compress_threads=None):
+    """
+    Dump a sra file to compressed fastq files without writing uncompressed fastq files to disk:
+    the reads printed by fasterq-dump are split by mate and piped into parallel compressors.
+
+    The output files are the gzipped files fasterq-dump would produce (--split-3):
+        <outdir>/<name>.sra_1.fastq.gz and <name>.sra_2.fastq.gz for the mates of paired-end spots,
+        <outdir>/<name>.sra.fastq.gz for single-end data (and unpaired reads of paired-end data)
+    Files are written to a temporary name and renamed when the dump succeeded, they are deleted if it failed.
+
+    threads: number of fasterq-dump threads
+    compress_threads: number of threads of each compressor (one per output file), threads by default
+
+    The layout detected from the reads is saved in <outdir>/<name>.sra.layout.json, read by fastq_layout.
+
+    Returns a dict with the layout ('single' or 'paired'), the files of the layout (the mates, or the single-end file),
+    the file of the unpaired reads of paired-end data (if any) and the number of spots
+    """
+    base = os.path.join(outdir, os.path.basename(sra))
+    paths = {'single': base + '.fastq.gz', 1: base + '_1.fastq.gz', 2: base + '_2.fastq.gz'}
+    if os.path.exists(base + LAYOUT_SUFFIX): # layout of a previous dump
+        os.remove(base + LAYOUT_SUFFIX)
+    writers = {}
+    def writer(key):
+        if key not in writers:
+            writers[key] = open_compressed(paths[key] + '.part', level=level, threads=compress_threads or threads,
+                                           compressor=compressor)
+        return writers[key]
+
+    # with --split-spot, the reads of a spot are printed one after the other under the same name
+    command = f'fasterq-dump --split-spot --stdout -e {threads} {sra}'
+    process = sp.Popen(shlex.split(command), stdout=sp.PIPE, bufsize=1024*1024)
+    spots, previous = 0, None
+    completed = False
+    try:
+        stream = process.stdout
+        while True:
+            record = [stream.readline(), stream.readline(), stream.readline(), stream.readline()]
+            if not record[0]:
+                break
+            if previous is None:
+                previous = record
+                continue
+            if record[0].split(None, 1)[0] == previous[0].split(None, 1)[0]: # mates of the same spot
+                writer(1).write(b''.join(previous))
+                writer(2).write(b''.join(record))
+                previous = None
+            else:
+                writer('single').write(b''.join(previous))
+                previous = record
+            spots += 1
+        if previous is not None:
+            writer('single').write(b''.join(previous))
+            spots += 1
+        for w in writers.values():
+            w.close()
+        completed = True
+    finally:
+        if not completed:
+            # stop fasterq-dump, which would otherwise block on the full pipe, and the compressors
+            process.kill()
+            for w in writers.values():
+                w.abort()
+        process.stdout.close()
+        returncode = process.wait()
+        if not completed or returncode != 0:
+            for key in paths:
+                if os.path.exists(paths[key] + '.part'):
+                    os.remove(paths[key] + '.part')
+
+    if returncode != 0:
+        raise sp.CalledProcessError(returncode, command)
+    for key in writers:
+        os.replace(paths[key] + '.part', paths[key])
+    if 1 in writers:
+        result = {'layout': 'paired', 'files': [paths[1], paths[2]],
+                  'unpaired': [paths['single']] if 'single' in writers else [], 'spots': spots}
+    else:
+        result = {'layout': 'single', 'files': [paths['single']] if writers else [], 'unpaired': [], 'spots': spots}
+    with open(base + LAYOUT_SUFFIX + '.part', 'w') as f:
+        json.dump({key: [os.path.basename(f) for f in value] if isinstance(value, list) else value
+                   for key, value in result.items()}, f)
+    os.replace(base + LAYOUT_SUFFIX + '.part', base + LAYOUT_SUFFIX)
+    return result
+
+
+def fastq_layout(fastqdir):
+    """
+    Find the single-end and paired-end samples of a directory of (compressed) fastq files written by fasterq-dump:
+    the layout detected by dump_compressed (saved in <sample>.sra.layout.json), or for the samples dumped otherwise,
+    the layout given by the names of the files (<sample>.sra_1.fastq and <sample>.sra_2.fastq for paired-end data)
+    Returns a dict {sample: {'layout': 'single' or 'paired', 'files': [fastq files]}}
+    """
+    samples, layouts = {}, {}
+    for f in sorted(os.listdir(fastqdir)):
+        sample = f.split('.')[0]
+        if f.endswith(LAYOUT_SUFFIX):
+            with open(os.path.join(fastqdir, f)) as layout:
+                layout = json.load(layout)
+            layouts[sample] = {'layout': layout['layout'], 'files': [os.path.join(fastqdir, name) for name in layout['files']]}
+        elif f.endswith('.fastq') or f.endswith('.fastq.gz'):
+            samples.setdefault(sample, []).append(os.path.join(fastqdir, f))
+    for sample, files in samples.items():
+        if sample in layouts:
+            continue
+        mates = [f for f in files if '.sra_1.fastq' in f or '.sra_2.fastq' in f]
+        layouts[sample] = {'layout': 'paired', 'files': mates} if mates else {'layout': 'single', 'files': files}
+    return layouts
@@ -0,0 +1,185 @@
+### Gene-set libraries (GMT files) parsed once and cached as integer-coded arrays ###
+
+import os, json, hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+
+CACHE_VERSION = 1
+CACHE_ARRAYS = ['terms', 'genes', 'offsets', 'gene_ids']
+
+class GeneSetLibrary():
+    """
+    A gene-set library stored in a compact integer-coded form:
+        terms: array of the n_terms term names
+        genes: array of the unique genes of the library
+        offsets: array of n_terms+1 positions, the genes of term i are gene_ids[offsets[i]:offsets[i+1]]
+        gene_ids: concatenated indices of the genes of each term in the genes array
+
+    Libraries are best created with GeneSetLibrary.load(gmt_fn) which parses a GMT file once per session
+    and persists the arrays in a memory-mappable cache next to the file (gmt_fn + '.cache'),
+    invalidated when the file changes.
+    """
+    _loaded = {} # libraries already loaded in this session, by path
+
+    def __init__(self, terms, genes, offsets, gene_ids, name=None):
+        self.terms = terms
+        self.genes = genes
+        self.offsets = offsets
+        self.gene_ids = gene_ids
+        self.name = name
+        self._membership_cache = {}
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        """Iterate over (term, genes) tuples, as returned by geode.read_gmt"""
+        for i in range(len(self)):
+            yield self.terms[i], self.gene_set(i)
+
+    def __repr__(self):
+        return f'GeneSetLibrary({self.name!r}, {len(self)} terms, {len(self.genes)} genes)'
+
+    def gene_set(self, i):
+        """Return the list of genes of the i-th term"""
+        return self.genes[self.gene_ids[self.offsets[i]:self.offsets[i+1]]].tolist()
+
+    @classmethod
+    def from_gene_sets(cls, gene_sets, name=None):
+        """Build a library from a dict {term: genes} or a list of (term, genes) tuples"""
+        if isinstance(gene_sets, dict):
+            gene_sets = gene_sets.items()
+        terms, offsets, gene_ids = [], [0], []
+        vocabulary = {}
+        for term, genes in gene_sets:
+            terms.append(term)
+            gene_ids += [vocabulary.setdefault(gene, len(vocabulary)) for gene in genes]
+            offsets.append(len(gene_ids))
+        return cls(terms= np.array(terms, dtype=str),
+                   genes= np.array(list(vocabulary), dtype=str),
+                   offsets= np.array(offsets, dtype=np.int64),
+                   gene_ids= np.array(gene_ids, dtype=np.int32),
+                   name= name)
+
+    @classmethod
+    def from_gmt(cls, gmt_fn):
+        """Parse a GMT file (fuzzy GMTs with 'gene,weight' entries are detected automatically)"""
+        if not gmt_fn.endswith('.gmt'):
+            raise IOError("The gene-set library file is not in GMT format")
+
+        def parse(f):
+            for line in f:
+                sl = line.strip().split('\t')
+                if len(sl) < 3:
+                    continue
+                genes = sl[2:]
+                if ',' in genes[0]: ## auto detect fuzzy gmts
+                    genes = [gene.split(',')[0] for gene in genes]
+                yield sl[0], genes
+
+        with open(gmt_fn) as f:
+            return cls.from_gene_sets(parse(f), name=os.path.basename(gmt_fn)[:-4])
+
+    @classmethod
+    def load(cls, gmt_fn, cache=True):
+        """
+        Load a GMT file, reusing the library already loaded in this session or its cache on disk if the file did not change
+
+        gmt_fn: file name of a gene-set library in GMT format
+        cache: whether to read and write the binary cache stored in gmt_fn + '.cache'
+        """
+        path = os.path.abspath(gmt_fn)
+        stat = os.stat(path)
+        loaded = cls._loaded.get(path)
+        if loaded is not None and loaded[0] == (stat.st_mtime_ns, stat.st_size):
+            return loaded[1]
+
+        library = cls._read_cache(path, stat) if cache else None
+        if library is None:
+            library = cls.from_gmt(path)
+            if cache:
+                library._write_cache(path, stat)
+        cls._loaded[path] = ((stat.st_mtime_ns, stat.st_size), library)
+        return library
+
+    @staticmethod
+    def _file_hash(path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    @classmethod
+    def _read_cache(cls, path, stat):
+        """Memory-map the cached arrays, returns None if there is no valid cache"""
+        cache_dir = path + '.cache'
+        try:
+            with open(os.path.join(cache_dir, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != CACHE_VERSION or meta.get('size') != stat.st_size:
+            return None
+        if meta.get('mtime_ns') != stat.st_mtime_ns:
+            # the file was touched, only reparse it if its content changed
+            if meta.get('sha1') != cls._file_hash(path):
+                return None
+            meta['mtime_ns'] = stat.st_mtime_ns
+            cls._write_meta(cache_dir, meta)
+        try:
+            arrays = {key: np.load(os.path.join(cache_dir, key+'.npy'), mmap_mode='r') for key in CACHE_ARRAYS}
+        except (OSError, ValueError):
+            return None
+        return cls(name=meta.get('name'), **arrays)
+
+    def _write_cache(self, path, stat):
+        """Save the arrays next to the GMT file, the metadata is written last so that partial caches are ignored"""
+        cache_dir = path + '.cache'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for key in CACHE_ARRAYS:
+                tmp = os.path.join(cache_dir, key+'.tmp.npy')
+                np.save(tmp, getattr(self, key))
+                os.replace(tmp, os.path.join(cache_dir, key+'.npy'))
+            meta = {'version': CACHE_VERSION, 'name': self.name, 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns, 'sha1': self._file_hash(path)}
+            self._write_meta(cache_dir, meta)
+        except OSError as e:
+            print('could not write the gene-set library cache:', e)
+
+    @staticmethod
+    def _write_meta(cache_dir, meta):
+        tmp = os.path.join(cache_dir, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(cache_dir, 'meta.json'))
+
+    def membership(self, genes, case_sensitive=False):
+        """
+        Sparse term x gene indicator matrix of the genes of each term among a list of measured genes
+
+        genes: list or numpy.array of the measured genes (columns of the matrix)
+        case_sensitive: whether gene symbols should be considered as case_sensitive
+        """
+        genes = np.asarray(genes).astype(str)
+        key = (case_sensitive, len(genes), hashlib.sha1(genes.tobytes()).hexdigest())
+        if key not in self._membership_cache:
+            vocabulary = np.asarray(self.genes)
+            if not case_sensitive:
+                genes = np.char.upper(genes)
+                vocabulary = np.char.upper(vocabulary)
+
+            # position of each library gene among the measured genes, -1 if not measured
+            order = np.argsort(genes)
+            pos = np.searchsorted(genes, vocabulary, sorter=order).clip(max=max(len(genes)-1, 0))
+            found = genes[order[pos]] == vocabulary if len(genes) else np.zeros(len(vocabulary), dtype=bool)
+            vocab_to_genes = np.where(found, order[pos], -1)
+
+            cols = vocab_to_genes[self.gene_ids]
+            rows = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+            keep = cols >= 0
+            membership = csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=(len(self), len(genes)))
+            membership.data[:] = 1. # genes listed twice in a gene set are only counted once
+            self._membership_cache = {key: membership} # keep only the latest gene list
+        return self._membership_cache[key]
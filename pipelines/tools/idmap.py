@@ -0,0 +1,180 @@
+### Gene ID conversion (ENSEMBL -> symbol) answered from a local table, with batched queries to mygene/g:convert ###
+
+import os, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tools.annotation import strip_version
+
+IDMAP_DB = 'data/idmap.sqlite'
+
+class MyGeneBackend():
+    """Batch queries to the mygene.info API (as mygene.MyGeneInfo().querymany), at most 1000 IDs per request"""
+    name = 'mygene'
+    max_batch = 1000
+
+    def __init__(self, url='https://mygene.info/v3', scopes='ensembl.gene', field='symbol', species='human'):
+        self.url, self.scopes, self.field, self.species = url, scopes, field, species
+
+    def query(self, ids, session):
+        """{id: target or None} of a batch of IDs, the first hit is kept for IDs with several hits"""
+        response = session.post(f'{self.url}/query', data={'q': ','.join(ids), 'scopes': self.scopes,
+                                                            'fields': self.field, 'species': self.species}, timeout=60)
+        response.raise_for_status()
+        mapping = {}
+        for hit in response.json():
+            if hit['query'] not in mapping or mapping[hit['query']] is None:
+                mapping[hit['query']] = None if hit.get('notfound') else hit.get(self.field)
+        return mapping
+
+
+class GConvertBackend():
+    """Batch queries to the g:Profiler g:convert API"""
+    name = 'gconvert'
+    max_batch = 5000
+
+    def __init__(self, url='https://biit.cs.ut.ee/gprofiler/api/convert/convert/', organism='hsapiens', target='ENSG'):
+        self.url, self.organism, self.target = url, organism, target
+
+    def query(self, ids, session):
+        response = session.post(self.url, json={'organism': self.organism, 'target': self.target, 'query': list(ids)}, timeout=60)
+        response.raise_for_status()
+        mapping = {}
+        for hit in response.json()['result']:
+            name = None if hit.get('name') in (None, 'None', 'nan') else hit['name']
+            if hit['incoming'] not in mapping or mapping[hit['incoming']] is None:
+                mapping[hit['incoming']] = name
+        return mapping
+
+
+class TableBackend():
+    """Backend answering from a dict or Series {id: target}, to work offline or to mock the remote backends"""
+    name = 'table'
+    max_batch = 1000
+
+    def __init__(self, mapping, name='table'):
+        self.mapping = dict(mapping)
+        self.name = name
+        self.queried = [] # batches queried
+
+    def query(self, ids, session=None):
+        self.queried.append(list(ids))
+        return {i: self.mapping.get(i) for i in ids}
+
+
+class IDMapper():
+    """
+    Convert gene IDs (e.g. versioned or unversioned ENSEMBL IDs) to symbols, answering from a local table first.
+    IDs missing from the table are queried in batches, concurrently, to the backend and the results (including
+    the IDs not found) are saved in the table, tagged with the backend and a release, so that annotating
+    a new matrix usually needs no network calls:
+
+        idmap = IDMapper(release='2019-06')
+        counts['symbol'] = idmap.map(counts.index)
+
+    backend: MyGeneBackend (default), GConvertBackend, TableBackend or any object with a name and query(ids, session)
+    db: SQLite file of the local table
+    release: tag of the results (e.g. the date or version of the backend data), a new release queries the IDs again
+    batch_size: number of IDs per request (bounded by the maximum of the backend)
+    max_workers: maximum number of concurrent requests
+    version: whether the version of ENSEMBL IDs is kept in the queries (mygene and g:convert expect unversioned IDs)
+    """
+    def __init__(self, backend=None, db=IDMAP_DB, release='latest', batch_size=1000, max_workers=4, version=False,
+                 retries=5):
+        self.backend = backend or MyGeneBackend()
+        self.release = release
+        self.batch_size = min(batch_size, getattr(self.backend, 'max_batch', batch_size))
+        self.max_workers = max_workers
+        self.version = version
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'POST']))
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        if os.path.dirname(db):
+            os.makedirs(os.path.dirname(db), exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS idmap
+                (backend TEXT, release TEXT, query TEXT, target TEXT, PRIMARY KEY (backend, release, query))''')
+        rows = self.connection.execute('SELECT query, target FROM idmap WHERE backend=? AND release=?',
+                                       (self.backend.name, self.release)).fetchall()
+        # in-memory copy of the table of this backend and release, NaN for the IDs not found
+        self.table = pd.Series([target for _, target in rows], index=[query for query, _ in rows], dtype=object)
+
+    def __len__(self):
+        return len(self.table)
+
+    def _keys(self, ids):
+        ids = np.asarray(ids).astype(str)
+        return ids if self.version else strip_version(ids)
+
+    def _store(self, mapping):
+        """Add query results to the local table"""
+        if not mapping:
+            return
+        with self._lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO idmap VALUES (?,?,?,?)',
+                                        [(self.backend.name, self.release, query, target) for query, target in mapping.items()])
+        self.table = pd.concat([self.table[~self.table.index.isin(list(mapping))],
+                                pd.Series(list(mapping.values()), index=list(mapping), dtype=object)])
+
+    def _query(self, keys):
+        """Query unique IDs to the backend in batches of batch_size, max_workers batches at a time, and store the results"""
+        batches = [list(keys[i:i+self.batch_size]) for i in range(0, len(keys), self.batch_size)]
+        def query(batch):
+            result = self.backend.query(batch, self.session)
+            # IDs missing from the response are recorded as not found
+            return {query: result.get(query) for query in batch}
+        mapping = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for result in executor.map(query, batches):
+                mapping.update(result)
+        self._store(mapping)
+
+    def update(self, ids):
+        """Query the IDs missing from the local table, returns the number of IDs queried"""
+        keys = self._keys(ids)
+        missing = pd.unique(keys[self.table.index.get_indexer(keys) < 0])
+        if len(missing):
+            self._query(missing)
+        return len(missing)
+
+    def map(self, ids, offline=False):
+        """
+        Targets (e.g. symbols) of IDs, NaN for the IDs not found
+
+        ids: list, numpy array, pandas Index or Series of IDs
+        offline: only answer from the local table, without querying the missing IDs
+        Returns a Series aligned with ids (same index for a Series, indexed by the IDs otherwise)
+        """
+        keys = self._keys(ids)
+        positions = self.table.index.get_indexer(keys)
+        if not offline and (positions < 0).any():
+            self._query(pd.unique(keys[positions < 0]))
+            positions = self.table.index.get_indexer(keys)
+        found = positions >= 0
+        values = np.full(len(keys), np.nan, dtype=object)
+        values[found] = self.table.to_numpy()[positions[found]]
+        values[pd.isna(values)] = np.nan
+        index = ids.index if isinstance(ids, pd.Series) else pd.Index(np.asarray(ids))
+        return pd.Series(values, index=index, dtype=object)
+
+    def seed(self, mapping):
+        """Add known results to the local table, e.g. from a previous mygene query, see seed_from_ginfo"""
+        self._store({str(query): (None if pd.isna(target) else str(target)) for query, target in dict(mapping).items()})
+        return self
+
+    def seed_from_ginfo(self, ginfo_fn='ginfo.csv'):
+        """Import the results of mygene.querymany saved as CSV (query and symbol columns), keeping the first hit of each query"""
+        ginfo = pd.read_csv(ginfo_fn, usecols=['query', 'symbol'], dtype=str).drop_duplicates('query', keep='first')
+        return self.seed(zip(ginfo['query'].values, ginfo['symbol'].values))
+
+    def close(self):
+        self.connection.close()
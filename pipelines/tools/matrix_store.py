@@ -0,0 +1,158 @@
+### Binary store of expression matrices (genes/transcripts x samples) with memory-mapped, subset reads ###
+
+import os, json, shutil
+import numpy as np
+import pandas as pd
+
+STORE_VERSION = 1
+
+class MatrixStore():
+    """
+    An expression matrix saved as a directory of numpy arrays:
+        values.npy: rows x columns values (float32 or int32) in column-major order, so that each sample is
+                    stored contiguously and a subset of samples is read without reading the others
+        rows.npy, columns.npy: row (gene/transcript) and column (sample) labels
+        annotations/<name>.npy: row annotations, text columns are stored as categoricals
+                                (<name>.codes.npy and <name>.categories.npy)
+        meta.json: shape, dtype, index names and annotation columns, written last so that partial stores are ignored
+
+        MatrixStore.save(TPM, 'quant/salmon_TPM.matrix', annotations=gene_info)
+        TPM = MatrixStore('quant/salmon_TPM.matrix').load(columns=['SRR8914928', 'SRR8914929'])
+
+    The values are memory-mapped: only the rows and columns read are loaded from disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                self.meta = json.load(f)
+        except OSError:
+            raise IOError(f'{path} is not a matrix store')
+        if self.meta.get('version') != STORE_VERSION:
+            raise IOError(f'{path}: unsupported matrix store version {self.meta.get("version")}')
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.rows = pd.Index(np.load(os.path.join(path, 'rows.npy')), name=self.meta['rows_name'])
+        self.columns = pd.Index(np.load(os.path.join(path, 'columns.npy')), name=self.meta['columns_name'])
+
+    def __repr__(self):
+        return f'MatrixStore({self.path!r}, {self.shape[0]} rows x {self.shape[1]} columns, {self.values.dtype})'
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @classmethod
+    def save(cls, df, path, dtype=None, annotations=None):
+        """
+        Save a DataFrame, replacing any existing store
+
+        df: DataFrame of the matrix (rows x columns)
+        dtype: dtype of the stored values, defaults to int32 for integer matrices and float32 otherwise
+        annotations: optional DataFrame of row annotations (e.g. gene symbol, transcript type), aligned on df.index
+        """
+        if dtype is None:
+            dtype = np.int32 if all(pd.api.types.is_integer_dtype(t) for t in df.dtypes) else np.float32
+        tmp = path.rstrip('/') + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(os.path.join(tmp, 'annotations'))
+
+        # write the values one column at a time to avoid a copy of the whole matrix
+        values = np.lib.format.open_memmap(os.path.join(tmp, 'values.npy'), mode='w+', dtype=dtype,
+                                           shape=df.shape, fortran_order=True)
+        for j in range(df.shape[1]):
+            values[:, j] = df.iloc[:, j].values
+        values.flush()
+        del values
+        np.save(os.path.join(tmp, 'rows.npy'), np.asarray(df.index).astype(str))
+        np.save(os.path.join(tmp, 'columns.npy'), np.asarray(df.columns).astype(str))
+
+        annotation_columns = {}
+        if annotations is not None:
+            annotations = annotations.reindex(df.index)
+            for col in annotations.columns:
+                name = f'annotation{len(annotation_columns)}'
+                series = annotations[col]
+                if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+                    np.save(os.path.join(tmp, 'annotations', name+'.npy'), series.values)
+                    annotation_columns[str(col)] = {'file': name, 'categorical': False}
+                else:
+                    categorical = pd.Categorical(series)
+                    np.save(os.path.join(tmp, 'annotations', name+'.codes.npy'), categorical.codes)
+                    np.save(os.path.join(tmp, 'annotations', name+'.categories.npy'), np.asarray(categorical.categories).astype(str))
+                    annotation_columns[str(col)] = {'file': name, 'categorical': True}
+
+        meta = {'version': STORE_VERSION, 'shape': list(df.shape), 'dtype': np.dtype(dtype).name,
+                'rows_name': df.index.name, 'columns_name': df.columns.name, 'annotations': annotation_columns}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+        return cls(path)
+
+    def _positions(self, index, labels, axis):
+        """Positions of row/column labels (or a slice or a boolean mask), None for all"""
+        if labels is None:
+            return None
+        if isinstance(labels, slice):
+            return np.arange(len(index))[labels]
+        labels = np.asarray(labels)
+        if labels.dtype == bool:
+            return np.nonzero(labels)[0]
+        positions = index.get_indexer(labels)
+        if (positions < 0).any():
+            raise KeyError(f'{axis} not found: {list(labels[positions < 0][:10])}')
+        return positions
+
+    def load(self, rows=None, columns=None, dtype=None):
+        """
+        Load the matrix, or a subset of it, as a DataFrame
+
+        rows, columns: labels (or slice or boolean mask) of the rows (genes) and columns (samples) to read, None for all
+        dtype: convert the values, e.g. to float64 for computations requiring double precision
+        """
+        row_pos = self._positions(self.rows, rows, 'rows')
+        col_pos = self._positions(self.columns, columns, 'columns')
+        values = self.values
+        # columns are contiguous on disk: select them first so that only their data is read
+        if col_pos is not None:
+            values = values[:, col_pos]
+        if row_pos is not None:
+            values = values[row_pos, :]
+        values = np.array(values, dtype=dtype, order='F')
+        return pd.DataFrame(values, copy=False,
+                            index=self.rows if row_pos is None else self.rows[row_pos],
+                            columns=self.columns if col_pos is None else self.columns[col_pos])
+
+    def annotations(self, rows=None):
+        """DataFrame of the row annotations (text annotations as categoricals)"""
+        row_pos = self._positions(self.rows, rows, 'rows')
+        annotations = {}
+        for col, info in self.meta['annotations'].items():
+            base = os.path.join(self.path, 'annotations', info['file'])
+            if info['categorical']:
+                codes = np.load(base+'.codes.npy', mmap_mode='r')
+                codes = np.asarray(codes if row_pos is None else codes[row_pos])
+                annotations[col] = pd.Categorical.from_codes(codes, categories=np.load(base+'.categories.npy'))
+            else:
+                values = np.load(base+'.npy', mmap_mode='r')
+                annotations[col] = np.asarray(values if row_pos is None else values[row_pos])
+        return pd.DataFrame(annotations, index=self.rows if row_pos is None else self.rows[row_pos])
+
+    def to_csv(self, csv_fn, chunksize=10000, **kwargs):
+        """Export the matrix to a CSV file (as written by DataFrame.to_csv), chunk by chunk of rows"""
+        for start in range(0, self.shape[0], chunksize):
+            chunk = self.load(rows=slice(start, start+chunksize))
+            chunk.to_csv(csv_fn, mode='w' if start == 0 else 'a', header=start == 0, **kwargs)
+        return csv_fn
+
+
+def save_matrix(df, path, dtype=None, annotations=None):
+    """Save a matrix, see MatrixStore.save"""
+    return MatrixStore.save(df, path, dtype=dtype, annotations=annotations)
+
+
+def load_matrix(path, rows=None, columns=None, dtype=None):
+    """Load a matrix or a subset of its rows and columns, see MatrixStore.load"""
+    return MatrixStore(path).load(rows=rows, columns=columns, dtype=dtype)
@@ -0,0 +1,149 @@
+### Normalisation (CPM, log transforms) and filtering of lowly expressed genes, chunk by chunk in float32 ###
+
+import numpy as np
+import pandas as pd
+
+CHUNKSIZE = 8192 # rows (genes) processed at a time
+
+def _values(x):
+    """numpy array of a matrix (DataFrame, array or memmap), without copy"""
+    return x.to_numpy() if isinstance(x, pd.DataFrame) else x
+
+def _like(x, values, index=None):
+    """values as a DataFrame with the labels of x if x is a DataFrame, without copy"""
+    if not isinstance(x, pd.DataFrame):
+        return values
+    return pd.DataFrame(values, index=x.index if index is None else index, columns=x.columns, copy=False)
+
+def _output(x, out, dtype):
+    """Output array of an element-wise transformation of x: out, or a new array of dtype (x itself with out=x)"""
+    if out is None:
+        return np.empty(x.shape, dtype=dtype)
+    if isinstance(out, pd.DataFrame):
+        raise ValueError('out has to be a numpy array or memmap, DataFrame values are read-only')
+    if out.shape != x.shape:
+        raise ValueError(f'out has shape {out.shape}, expected {x.shape}')
+    if not np.issubdtype(out.dtype, np.floating):
+        raise ValueError(f'out has dtype {out.dtype}, a floating point dtype is required (e.g. counts.astype(np.float32))')
+    return out
+
+def chunks(n_rows, chunksize=CHUNKSIZE):
+    """Slices of chunksize rows"""
+    for start in range(0, n_rows, chunksize):
+        yield slice(start, min(start + chunksize, n_rows))
+
+
+def library_sizes(counts, chunksize=CHUNKSIZE):
+    """Library size (sum of the counts) of each sample, accumulated in float64 chunk by chunk"""
+    values = _values(counts)
+    sizes = np.zeros(values.shape[1])
+    for rows in chunks(values.shape[0], chunksize):
+        sizes += values[rows].sum(axis=0, dtype=np.float64)
+    return pd.Series(sizes, index=counts.columns) if isinstance(counts, pd.DataFrame) else sizes
+
+
+def cpm(counts, lib_sizes=None, out=None, dtype=np.float32, chunksize=CHUNKSIZE):
+    """
+    Counts per million: counts / library size * 1e6
+
+    counts: genes x samples counts (DataFrame, array or memmap)
+    lib_sizes: library sizes of the samples, computed from counts by default
+    out: array (or memmap, e.g. np.lib.format.open_memmap) of a floating point dtype receiving the CPM,
+         counts itself to normalise float counts in place, a new array of dtype by default
+    """
+    values = _values(counts)
+    if lib_sizes is None:
+        lib_sizes = library_sizes(values, chunksize=chunksize)
+    out = _output(values, out, dtype)
+    scale = 1e6 / np.asarray(lib_sizes, dtype=np.float64)
+    for rows in chunks(values.shape[0], chunksize):
+        np.multiply(values[rows], scale, out=out[rows], casting='unsafe')
+    return _like(counts, out)
+
+
+def log_transform(x, base=2, pseudocount=0, out=None, dtype=np.float32, chunksize=CHUNKSIZE):
+    """
+    log(x + pseudocount) in base 2, 10 or e, e.g. log_transform(TPM, base=10, pseudocount=1) for np.log10(TPM+1)
+
+    out: array of a floating point dtype receiving the result, x itself to transform in place,
+         a new array of dtype by default
+    """
+    values = _values(x)
+    out = _output(values, out, dtype)
+    log = {2: np.log2, 10: np.log10, 'e': np.log}[base]
+    for rows in chunks(values.shape[0], chunksize):
+        chunk = out[rows]
+        if pseudocount:
+            np.add(values[rows], pseudocount, out=chunk, casting='unsafe')
+            log(chunk, out=chunk)
+        else:
+            with np.errstate(divide='ignore'):
+                log(values[rows], out=chunk, casting='unsafe')
+    return _like(x, out)
+
+
+def cpm_threshold(lib_sizes, min_count=5):
+    """CPM corresponding to min_count reads for the average library size"""
+    return min_count / np.mean(lib_sizes) * 1e6
+
+
+def min_group_size(meta, group_by):
+    """Size of the smallest group of samples of the metadata, groups being the combinations of the group_by column(s)"""
+    return int(meta.groupby(group_by).size().min())
+
+
+def expression_mask(cpm, threshold, min_samples=1, chunksize=CHUNKSIZE):
+    """
+    Boolean mask of the expressed genes: genes with a CPM > threshold in at least min_samples samples
+    (and so with non-zero counts)
+    """
+    values = _values(cpm)
+    mask = np.empty(values.shape[0], dtype=bool)
+    for rows in chunks(values.shape[0], chunksize):
+        mask[rows] = np.count_nonzero(values[rows] > threshold, axis=1) >= min_samples
+    return mask
+
+
+def compact_rows(x, mask, chunksize=CHUNKSIZE):
+    """
+    Keep the rows of an array (or memmap) selected by a boolean mask in place: the kept rows are moved to the top
+    of the array, chunk by chunk, and a view of them is returned (x[:n_kept]), without allocating a copy of the matrix
+    """
+    if isinstance(x, pd.DataFrame):
+        raise ValueError('compact_rows works on numpy arrays or memmaps, DataFrame values are read-only')
+    kept = np.nonzero(mask)[0]
+    # each kept row moves up (or stays): a chunk never overwrites rows not yet moved
+    for start in range(0, len(kept), chunksize):
+        positions = kept[start:start+chunksize]
+        if positions[0] != start or positions[-1] != start + len(positions) - 1:
+            x[start:start+len(positions)] = x[positions]
+    return x[:len(kept)]
+
+
+def apply_mask(mask, *matrices, chunksize=CHUNKSIZE):
+    """Filter the rows of aligned matrices (arrays or memmaps) in place with the same mask, see compact_rows"""
+    return [compact_rows(x, mask, chunksize=chunksize) for x in matrices]
+
+
+def filter_expressed(counts, *matrices, min_count=5, min_samples=None, meta=None, group_by=None, out=None,
+                     chunksize=CHUNKSIZE):
+    """
+    Normalise counts to CPM and filter out lowly expressed genes from the counts, the CPM and other aligned matrices
+    (e.g. TPM), in place
+
+    counts: genes x samples array (or memmap), filtered in place
+    matrices: other genes x samples arrays aligned with counts, filtered in place
+    min_count: genes are kept when their CPM is above the CPM of min_count reads (for the average library size)...
+    min_samples: ...in at least min_samples samples, by default the size of the smallest group of samples of meta
+                 (groups by the group_by column(s)) as in edgeR's filterByExpr
+    out: array (or memmap) receiving the CPM, a new float32 array by default
+    Returns (mask, CPM, counts, *matrices): the mask of the kept genes and views of the filtered matrices
+    """
+    if min_samples is None:
+        if meta is None or group_by is None:
+            raise ValueError('provide min_samples, or the metadata and grouping column(s) to derive it from')
+        min_samples = min_group_size(meta, group_by)
+    lib_sizes = library_sizes(counts, chunksize=chunksize)
+    CPM = cpm(counts, lib_sizes=lib_sizes, out=out, chunksize=chunksize)
+    mask = expression_mask(CPM, cpm_threshold(lib_sizes, min_count), min_samples, chunksize=chunksize)
+    return [mask] + apply_mask(mask, CPM, counts, *matrices, chunksize=chunksize)
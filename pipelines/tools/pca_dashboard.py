@@ -11,27 +11,212 @@ import numpy as np
 import pandas as pd
 
 from sklearn import datasets
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.preprocessing import StandardScaler
 
-import json
+import os, fcntl, hashlib, pickle, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+from tools.matrix_store import MatrixStore
+
+def data_fingerprint(data):
+    """Hash of the values and labels of a dataframe, identifying the data of cached PCA results"""
+    h = hashlib.sha1()
+    h.update(repr(data.shape).encode())
+    for labels in (data.index, data.columns):
+        h.update('\x1f'.join(map(str, labels)).encode())
+    values = data.to_numpy()
+    h.update(str(values.dtype).encode())
+    for start in range(0, values.shape[0], 256): #by chunks of rows, to avoid a copy of non-contiguous data
+        h.update(np.ascontiguousarray(values[start:start+256]).view(np.uint8).ravel())
+    return h.hexdigest()
+
+PCA_SOLVERS = ['full', 'randomized', 'incremental']
+PALETTE = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+FILTER_OPERATORS = [' eq ', ' ne ', ' >= ', ' <= ', ' > ', ' < ', ' contains ']
+
+def _row_batches(n_rows, batch_size, min_size):
+    """Slices of batch_size rows, the last batch being merged with the previous one if smaller than min_size"""
+    starts = list(range(0, n_rows, batch_size))
+    if len(starts) > 1 and n_rows - starts[-1] < min_size:
+        starts.pop()
+    return [slice(start, end) for start, end in zip(starts, starts[1:] + [n_rows])]
+
+def compute_pca(values, zscore=True, solver='full', n_components=None, batch_size=200):
+    """
+    Principal component analysis of a samples x features matrix
+    values: numpy array or memmap (e.g. np.load(fn, mmap_mode='r')) of the data
+    zscore: standardise each feature (as StandardScaler)
+    solver: 'full': exact decomposition (sklearn PCA), of all the components if n_components is None
+            'randomized': randomized SVD limited to n_components, much faster when n_components << number of samples
+            'incremental': IncrementalPCA fitted on batches of batch_size samples, so that only one batch
+                           of scaled data is in memory, for matrices too large for memory
+    n_components: number of components to compute, all for 'full' and 20 for the other solvers by default
+    Returns (projected data (samples x components), % of variance explained by each component,
+             components (components x features))
+    """
+    if solver not in PCA_SOLVERS:
+        raise ValueError(f'solver has to be one of {PCA_SOLVERS}')
+    if n_components is None and solver != 'full':
+        n_components = 20
+    if n_components is not None:
+        n_components = min(n_components, *values.shape)
+
+    if solver == 'incremental':
+        batches = _row_batches(values.shape[0], max(batch_size, n_components), n_components)
+        scale = lambda batch: batch
+        if zscore:
+            scaler = StandardScaler()
+            for rows in batches:
+                scaler.partial_fit(values[rows])
+            scale = scaler.transform
+        pca = IncrementalPCA(n_components=n_components)
+        for rows in batches:
+            pca.partial_fit(scale(values[rows]))
+        projected = np.vstack([pca.transform(scale(values[rows])) for rows in batches])
+    else:
+        norm_data = StandardScaler().fit_transform(values) if zscore else values
+        if solver == 'full':
+            pca = PCA(n_components=n_components, svd_solver='full')
+        else:
+            pca = PCA(n_components=n_components, svd_solver='randomized', random_state=0)
+        projected = pca.fit_transform(norm_data)
+    return projected, pca.explained_variance_ratio_ * 100, pca.components_
+
+def top_loadings(components, features, k):
+    """
+    The k features with the highest weights (in absolute value) of each component, in decreasing order,
+    selected with a single argpartition over all components
+    components: components x features array of weights
+    Returns a list of {feature: weight} dicts, one per component
+    """
+    features = np.asarray(features)
+    k = min(k, components.shape[1])
+    top = np.argpartition(-np.abs(components), k-1, axis=1)[:, :k]
+    weights = np.take_along_axis(components, top, axis=1)
+    order = np.argsort(-np.abs(weights), axis=1, kind='stable')
+    top, weights = np.take_along_axis(top, order, axis=1), np.take_along_axis(weights, order, axis=1)
+    return [dict(zip(features[idx].tolist(), w.tolist())) for idx, w in zip(top, weights)]
+
+class MemoryStore():
+    """In-process store of results by key, keeping the max_items most recently used"""
+    def __init__(self, max_items=8):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @contextmanager
+    def lock(self, key):
+        """Lock of a key, held while its result is computed so that it is computed once"""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            yield
+
+    def get(self, key):
+        """Result stored under key, raises KeyError if it is not (or no longer) in the store"""
+        with self._lock:
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+class DiskStore():
+    """Store of results by key as pickle files in a directory, shared by processes (e.g. the workers of a server)"""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    @contextmanager
+    def lock(self, key):
+        """File lock of a key, held while its result is computed so that it is computed once by all the processes"""
+        with open(self._path(key) + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
 
 class Dash_PCA(dash.Dash):
     
     external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
     nb_of_components = 20
-    def __init__(self, data, labels):
+    large_data_threshold = 2000 #number of samples above which the large data mode is used by default
+    _pca_cache = MemoryStore(8) #PCA results by data fingerprint and scaling, shared by the dashboards of a session
+    def __init__(self, data, labels, store=None, solver='full', n_components=None, workers=None,
+                 large=None, max_points=5000, page_size=50):
+        """
+        data, labels: see run_dashboard
+        store: server-side store of the PCA results (MemoryStore or DiskStore), an in-process store shared
+               by the dashboards of the session by default. Only the handles of the results go to the browser.
+        solver, n_components: PCA solver and number of components computed, see compute_pca
+        workers: number of background threads computing the PCA results requested by the callbacks (numpy and
+                 scikit-learn release the GIL during the decomposition), None to compute them in the callbacks
+        large: large data mode, by default for more than large_data_threshold samples: PC1 x PC2 WebGL scatter plot
+               of at most max_points samples (all the samples of the zoomed or selected area if there are at most
+               max_points of them), colours updated in the browser, table paginated by the server (page_size rows)
+        """
         super().__init__(__name__, external_stylesheets= self.external_stylesheets)
         self.title = 'PCA analysis'
         self.labels = labels
         self.labelled_data = pd.DataFrame.join(data, labels)
-        self.projected_data, self.variance_explained, self.components = self.perform_pca(data)
+        self.data = data
+        self.fingerprint = data_fingerprint(data)
+        self.store = self._pca_cache if store is None else store
+        self.solver = solver
+        self.n_components = n_components
+        self._pending = {} #PCA results being computed by the workers, by key
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.executor = None
+        self.open()
+        self.large = len(data) > self.large_data_threshold if large is None else large
+        self.max_points = max_points
+        self.page_size = page_size
+        self.handle = self.pca_handle()
+        self.projected_data, self.variance_explained, self.components = self.pca_result(self.handle)
+        if self.large:
+            scatter_stores = [dcc.Store(id='scatter_points', data= self.scatter_points(self.handle)),
+                              dcc.Store(id='scatter_colors', data= self.scatter_colors(self.labels.iloc[:,0]))]
+            scatter_figure = {'data': [], 'layout': {}} #drawn in the browser from the stores
+        else:
+            scatter_stores = []
+            scatter_figure = self.plot_pca(self.projected_data, self.variance_explained, self.labels.iloc[:,0])
 
         #Create layout
-        self.layout = html.Div([    
-            dcc.Store(id='projected_data', data= self.projected_data.to_json(orient='split')),
-            dcc.Store(id='variance_explained', data= json.dumps(self.variance_explained.tolist())),
-            dcc.Store(id='components', data= json.dumps(self.components)),
+        self.layout = html.Div(scatter_stores + [    
+            dcc.Store(id='pca_handle', data= self.handle),
             
             html.Div([
                         html.H4('Feature scaling (zscore)'),
@@ -43,6 +228,16 @@ class Dash_PCA(dash.Dash):
                             ],
                             value= 'On',
                             labelStyle={'display': 'inline-block'}
+                    ),
+                        html.H4('Number of components'),
+                        dcc.Input(
+                            id= 'n_components_input',
+                            type= 'number',
+                            min= 3,
+                            step= 1,
+                            value= self.handle['n_components'],
+                            placeholder= 'all',
+                            debounce= True,
                     ),], style= {'grid-area': 'pca-options'}
                  ),
             
@@ -72,7 +267,7 @@ class Dash_PCA(dash.Dash):
             
             dcc.Graph(
                     id='3d scatter',
-                    figure= self.plot_pca(self.projected_data, self.variance_explained, self.labels.iloc[:,0]),
+                    figure= scatter_figure,
                     config=dict(showSendToCloud=True),
                     style= {'grid-area': 'pca'}
             ),
@@ -92,29 +287,93 @@ class Dash_PCA(dash.Dash):
                     }
     )
         
-    def perform_pca(self, data, zscore=True, max_components=nb_of_components):
-        """Performs principal component analysis on a dataframe"""
-        
-        if zscore:
-            # Standardise using StandardScaler
-            norm_data= pd.DataFrame(StandardScaler().fit_transform(data), columns=data.columns)
-        else:
-            norm_data=data
-
-        # Perform PCA
-        pca = PCA(n_components=None)    
-        pca.fit(norm_data)
-        variance_explained = pca.explained_variance_ratio_ * 100
-        projected_data = pd.DataFrame(pca.transform(norm_data), index= data.index, 
-                                      columns= ['PC'+str(i+1) for i in range(len(pca.explained_variance_ratio_))])
-        components = pd.DataFrame(pca.components_, columns=norm_data.columns)
-        main_components = []
-        for name, row in components.iterrows():
-            #keep only the components with the highest weights (in absolute value)
-            main_components += [row.reindex(row.abs().sort_values(ascending=False).index)[:min(max_components, len(row))].to_dict()]
+    def perform_pca(self, data, zscore=True, max_components=nb_of_components, solver=None, n_components=None):
+        """Performs principal component analysis on a dataframe (see compute_pca), by default with the solver
+        and number of components of the dashboard"""
+        projected, variance_explained, components = compute_pca(data.to_numpy(), zscore,
+                                                                 solver= solver or self.solver,
+                                                                 n_components= n_components or self.n_components)
+        projected_data = pd.DataFrame(projected, index= data.index, 
+                                      columns= ['PC'+str(i+1) for i in range(len(variance_explained))])
+        #keep only the components with the highest weights (in absolute value)
+        main_components = top_loadings(components, data.columns, max_components)
 
         return projected_data, variance_explained, main_components
-        
+
+    def pca_handle(self, zscore=True, n_components=None):
+        """
+        Handle of the PCA results of the data of the dashboard with or without scaling, the results are computed
+        in the background if there are workers (fetch them with pca_result), before returning otherwise
+        """
+        handle = {'data': self.fingerprint, 'zscore': zscore, 'solver': self.solver,
+                  'n_components': n_components or self.n_components}
+        if self.executor is None:
+            self.pca_result(handle)
+        else:
+            self._request(handle)
+        return handle
+
+    def _key(self, handle):
+        if handle['data'] != self.fingerprint:
+            raise ValueError('the PCA results were not computed on the data of this dashboard')
+        return f"pca-{handle['data']}-{'zscore' if handle['zscore'] else 'raw'}-{handle['solver']}-{handle['n_components']}"
+
+    def _compute(self, handle, key):
+        try:
+            #other threads or processes sharing the store wait for the result instead of computing it again
+            with self.store.lock(key):
+                try:
+                    return self.store.get(key)
+                except KeyError:
+                    pass
+                result = self.perform_pca(self.data, handle['zscore'], solver=handle['solver'],
+                                          n_components=handle['n_components'])
+                self.store.put(key, result)
+                return result
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _request(self, handle):
+        """Future of the PCA results of a handle being computed by the workers (submitting them if needed), None if they are stored"""
+        key = self._key(handle)
+        if self.executor is None or key in self.store:
+            return None
+        with self._lock:
+            if key not in self._pending:
+                if self.executor is None or key in self.store: # closed or stored since checked
+                    return None
+                self._pending[key] = self.executor.submit(self._compute, handle, key)
+            return self._pending[key]
+
+    def pca_result(self, handle):
+        """
+        PCA results (projected_data, variance_explained, components) of a handle, from the store,
+        or computed (see perform_pca) if they are not (or no longer) in the store, waiting for the workers
+        if they are computing them
+        """
+        key = self._key(handle)
+        try:
+            return self.store.get(key)
+        except KeyError:
+            future = self._request(handle)
+            if future is not None:
+                return future.result()
+            return self._compute(handle, key)
+
+    def open(self):
+        """Start the workers, if the dashboard has workers and they are not running (e.g. after close)"""
+        with self._lock:
+            if self.workers and self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pca')
+
+    def close(self):
+        """Stop the workers (the results requested afterwards are computed in the callbacks until open is called)"""
+        with self._lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
     def plot_group_pca(self, projected_data, color_by):
         """Plots a 3D scatter plot of 3 consecutive principal components with dots colored by group"""
         pca_data = pd.DataFrame.join(projected_data, color_by)
@@ -170,6 +429,55 @@ class Dash_PCA(dash.Dash):
                         )
         return {'data': data, 'layout':layout}
 
+    def scatter_region(self, relayoutData=None, selectedData=None):
+        """Area ({'x': [min, max], 'y': [min, max]}) selected (box or lasso) or zoomed in the scatter plot, None for all"""
+        if selectedData and selectedData.get('range'):
+            return {axis: sorted(selectedData['range'][axis]) for axis in ('x', 'y')}
+        if selectedData and selectedData.get('lassoPoints'):
+            return {axis: [min(selectedData['lassoPoints'][axis]), max(selectedData['lassoPoints'][axis])] for axis in ('x', 'y')}
+        if relayoutData:
+            region = {axis: sorted([relayoutData[f'{axis}axis.range[0]'], relayoutData[f'{axis}axis.range[1]']])
+                      for axis in ('x', 'y') if f'{axis}axis.range[0]' in relayoutData}
+            if region:
+                return region
+        return None
+
+    def scatter_points(self, handle, region=None):
+        """
+        PC1 and PC2 of the samples plotted in large data mode: the samples of region (see scatter_region, all by default),
+        or a random subset of max_points of them if there are more (the same subset for a given region)
+        """
+        projected_data, variance_explained, components = self.pca_result(handle)
+        pcs = projected_data.loc[:, ['PC1', 'PC2']].to_numpy()
+        shown = np.ones(len(pcs), dtype=bool)
+        for axis, pc in (('x', 0), ('y', 1)):
+            if region and axis in region:
+                shown &= (pcs[:, pc] >= region[axis][0]) & (pcs[:, pc] <= region[axis][1])
+        shown = np.nonzero(shown)[0]
+        if len(shown) > self.max_points:
+            shown = np.sort(np.random.default_rng(0).choice(shown, self.max_points, replace=False))
+        return {'x': pcs[shown, 0].tolist(), 'y': pcs[shown, 1].tolist(), 'index': shown.tolist(),
+                'text': projected_data.index[shown].astype(str).tolist(), 'n': len(pcs), 'shown': len(shown),
+                'xtitle': f'PC1 ({variance_explained[0]:.2f}%)', 'ytitle': f'PC2 ({variance_explained[1]:.2f}%)',
+                'revision': self._key(handle)}
+
+    def scatter_colors(self, color_by):
+        """
+        Colour of every sample (in the order of the data) in large data mode: values of a numeric column,
+        codes of the categories otherwise, with a discrete colour scale
+        """
+        if pd.api.types.is_numeric_dtype(color_by) and not pd.api.types.is_bool_dtype(color_by):
+            values = color_by.to_numpy(dtype=float)
+            return {'color': np.where(np.isnan(values), None, values).tolist(), 'colorscale': 'Viridis',
+                    'ticktext': None, 'name': str(color_by.name)}
+        categories = pd.Categorical(color_by)
+        n = max(len(categories.categories), 1)
+        colorscale = []
+        for i in range(n):
+            colorscale += [[i/n, PALETTE[i % len(PALETTE)]], [(i+1)/n, PALETTE[i % len(PALETTE)]]]
+        return {'color': [None if code < 0 else int(code) for code in categories.codes], 'colorscale': colorscale,
+                'ticktext': [str(category) for category in categories.categories], 'name': str(color_by.name)}
+
     def plot_var(self, variance_explained):
         """Plots a bar chart of the percentage of variance explained by each principal component"""
         figure= {
@@ -215,8 +523,28 @@ class Dash_PCA(dash.Dash):
         return figure
 
     def generate_table(self, df):
-        """Generate a html table displaying the content of a pandas dataframe"""
+        """Generate a html table displaying the content of a pandas dataframe, paginated by the server in large data mode"""
         dataframe = df.reset_index()
+        if self.large:
+            self.table_data = dataframe
+            return dash_table.DataTable(
+                id= 'table',
+                columns= [{"name": i, "id": i} for i in dataframe.columns],
+                data= self.table_page({'current_page': 0, 'page_size': self.page_size}),
+                pagination_mode='be',
+                pagination_settings={'current_page': 0, 'page_size': self.page_size},
+                sorting='be',
+                sorting_type='multi',
+                sorting_settings=[],
+                filtering='be',
+                filtering_settings='',
+                style_as_list_view=True,
+                style_cell={'padding': '5px'},
+                style_header={
+                    'fontWeight': 'bold'
+                    },
+                n_fixed_rows= 2,
+                )
         table = dash_table.DataTable(
             id= 'table',
             columns= [{"name": i, "id": i, 'deletable': True} for i in dataframe.columns],
@@ -234,32 +562,61 @@ class Dash_PCA(dash.Dash):
 
         return table
 
-def run_dashboard(data, labels):
-    """Creates a dashboard for visual exploration of PCA analysis
-    
-    data: a pandas dataFrame whose columns contain the features on which to perform PCA
-    labels: a pandas dataFrame whose columns contain the labels, the index must be identical to data
-    """
+    def table_page(self, pagination_settings, sorting_settings=None, filtering_settings=''):
+        """
+        Rows of a page of the table in large data mode, after filtering ('col eq value && col > 10', as written by
+        the table filters) and sorting
+        """
+        dataframe = self.table_data
+        for expression in (filtering_settings or '').split(' && '):
+            operator = next((op for op in FILTER_OPERATORS if op in expression), None)
+            if operator is None:
+                continue
+            col, value = (part.strip().strip('"{}\'') for part in expression.split(operator, 1))
+            if col not in dataframe.columns:
+                continue
+            column = dataframe[col]
+            if operator.strip() == 'contains':
+                dataframe = dataframe.loc[column.astype(str).str.contains(value, regex=False)]
+                continue
+            if pd.api.types.is_numeric_dtype(column):
+                try:
+                    value = float(value)
+                except ValueError:
+                    continue
+            else:
+                column = column.astype(str)
+            dataframe = dataframe.loc[{'eq': column == value, 'ne': column != value, '>=': column >= value,
+                                       '<=': column <= value, '>': column > value, '<': column < value}[operator.strip()]]
+        if sorting_settings:
+            dataframe = dataframe.sort_values([col['column_id'] for col in sorting_settings],
+                                              ascending=[col['direction'] == 'asc' for col in sorting_settings])
+        start = pagination_settings['current_page'] * pagination_settings['page_size']
+        return dataframe.iloc[start:start + pagination_settings['page_size']].to_dict('records')
+
+def create_app(data, labels, store=None, solver='full', n_components=None, workers=None, large=None, max_points=5000):
+    """Creates a dashboard for visual exploration of PCA analysis, with its callbacks (see run_dashboard for the arguments)
+    app.server is the WSGI application of the dashboard"""
     ### Create App ###
-    app = Dash_PCA(data, labels)
+    app = Dash_PCA(data, labels, store=store, solver=solver, n_components=n_components, workers=workers,
+                   large=large, max_points=max_points)
     
     ### Add Interactivity ###
+    #the PCA results stay on the server, only their handle goes through the browser
     @app.callback(
-        [dash.dependencies.Output('projected_data', 'data'),
-        dash.dependencies.Output('variance_explained', 'data'),
-        dash.dependencies.Output('components', 'data')],
-        [dash.dependencies.Input('scaling_radio', 'value')])
-    def update_pca(scaling):
-        #recompute pca
+        dash.dependencies.Output('pca_handle', 'data'),
+        [dash.dependencies.Input('scaling_radio', 'value'),
+         dash.dependencies.Input('n_components_input', 'value')])
+    def update_pca(scaling, n_components):
+        #recompute pca, or reuse it if it was already computed with this scaling and number of components
         zscore = True if scaling == 'On' else False
-        projected_data, variance_explained, components = app.perform_pca(data, zscore)
-        return [projected_data.to_json(orient='split'), json.dumps(variance_explained.tolist()), json.dumps(components)]
+        return app.pca_handle(zscore, int(n_components) if n_components else None)
         
     @app.callback(
         dash.dependencies.Output('histo_var', 'figure'),
-        [dash.dependencies.Input('variance_explained', 'data')])
-    def update_var_plot(variance_explained_json):
-        variance_explained = json.loads(variance_explained_json)
+        [dash.dependencies.Input('pca_handle', 'data')])
+    def update_var_plot(handle):
+        projected_data, variance_explained, components = app.pca_result(handle)
         return app.plot_var(variance_explained)
     
     @app.callback(
@@ -273,11 +630,11 @@ def run_dashboard(data, labels):
     
     @app.callback(
         dash.dependencies.Output('histo_coef', 'figure'),
-        [dash.dependencies.Input('components', 'data'),
+        [dash.dependencies.Input('pca_handle', 'data'),
          dash.dependencies.Input('histo_var', 'selectedData'),
          dash.dependencies.Input('colorby_dropdown', 'value')],
         [dash.dependencies.State('histo_coef', 'figure')])
-    def update_coef_plot(components_json, selectedPC, dropdown_value, current_state):
+    def update_coef_plot(handle, selectedPC, dropdown_value, current_state):
         #if the callback is triggered by the dropdown, just update the selected bar
         if dash.callback_context.triggered[0]['prop_id'] == 'colorby_dropdown.value':
             figure = current_state
@@ -289,17 +646,75 @@ def run_dashboard(data, labels):
             return figure
         #if the callback was triggered by PC selection, show corresponding coefs, else show coefs for PC1
         PC = selectedPC['points'][0]['pointIndex'] if dash.callback_context.triggered[0]['prop_id'] == 'histo_var.selectedData' else 0
-        component_dict = json.loads(components_json)[PC]
+        component_dict = app.pca_result(handle)[2][PC]
         return app.plot_coef(pd.Series(component_dict, name=PC), dropdown_value)
 
     
+    if app.large:
+        #the points are sent when the PCA, the zoom or the selection change, the colours when the dropdown changes,
+        #and the figure is assembled in the browser (assets/pca_dashboard.js)
+        @app.callback(
+            dash.dependencies.Output('scatter_points', 'data'),
+            [dash.dependencies.Input('pca_handle', 'data'),
+             dash.dependencies.Input('3d scatter', 'relayoutData'),
+             dash.dependencies.Input('3d scatter', 'selectedData')])
+        def update_scatter_points(handle, relayoutData, selectedData):
+            triggered = dash.callback_context.triggered[0]['prop_id']
+            if triggered == '3d scatter.relayoutData':
+                region = app.scatter_region(relayoutData=relayoutData)
+            elif triggered == '3d scatter.selectedData':
+                region = app.scatter_region(selectedData=selectedData)
+            else:
+                region = None
+            return app.scatter_points(handle, region)
+
+        @app.callback(
+            dash.dependencies.Output('scatter_colors', 'data'),
+            [dash.dependencies.Input('colorby_dropdown', 'value')])
+        def update_scatter_colors(dropdown_value):
+            return app.scatter_colors(app.labelled_data.loc[:,dropdown_value])
+
+        app.clientside_callback(
+            dash.dependencies.ClientsideFunction(namespace='pca_dashboard', function_name='scatter_figure'),
+            dash.dependencies.Output('3d scatter', 'figure'),
+            [dash.dependencies.Input('scatter_points', 'data'),
+             dash.dependencies.Input('scatter_colors', 'data')])
+
+        @app.callback(
+            dash.dependencies.Output('table', 'data'),
+            [dash.dependencies.Input('table', 'pagination_settings'),
+             dash.dependencies.Input('table', 'sorting_settings'),
+             dash.dependencies.Input('table', 'filtering_settings')])
+        def update_table(pagination_settings, sorting_settings, filtering_settings):
+            return app.table_page(pagination_settings, sorting_settings, filtering_settings)
+
+        #link the table page to the scatter plot
+        @app.callback(
+            dash.dependencies.Output('table', 'style_data_conditional'),
+            [dash.dependencies.Input('3d scatter', 'clickData'), dash.dependencies.Input('table', 'data')])
+        def highlight_page_row(clickData, rows):
+            if clickData:
+                sample = clickData['points'][0]['text']
+                index_column = app.table_data.columns[0]
+                matches = [row for row, values in enumerate(rows) if str(values[index_column]) == sample]
+                if matches:
+                    return [{
+                        "if": {"row_index": matches[0]},
+                        "backgroundColor": "#3D9970",
+                        'color': 'white'
+                    }]
+            return []
+
+        return app
+
     @app.callback(
         dash.dependencies.Output('3d scatter', 'figure'),
         [dash.dependencies.Input('colorby_dropdown', 'value'), 
-         dash.dependencies.Input('projected_data', 'data'),
-         dash.dependencies.Input('variance_explained', 'data')])
-    def update_scatter(dropdown_value, projected_data_json, variance_explained):
-        return app.plot_pca(pd.read_json(projected_data_json, orient='split'), json.loads(variance_explained), app.labelled_data.loc[:,dropdown_value])
+         dash.dependencies.Input('pca_handle', 'data')])
+    def update_scatter(dropdown_value, handle):
+        #only the 3 PCs plotted are read
+        projected_data, variance_explained, components = app.pca_result(handle)
+        return app.plot_pca(projected_data.loc[:, ['PC1', 'PC2', 'PC3']], variance_explained[:3], app.labelled_data.loc[:,dropdown_value])
 
     #link table to scatter plot
     @app.callback(
@@ -317,8 +732,87 @@ def run_dashboard(data, labels):
                 "backgroundColor": "#3D9970",
                 'color': 'white'
             }]
+    return app
+
+class DashboardServer():
+    """
+    Serves a dashboard with a multi-threaded WSGI server running in a background thread, so that callbacks run
+    concurrently and do not block the caller (e.g. a notebook kernel)
+
+        server = DashboardServer(app).start()
+        server.stop()
+    """
+    def __init__(self, app, host='127.0.0.1', port=8050):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/'
+
+    def start(self):
+        if self.server is None:
+            self.server = make_server(self.host, self.port, self.app.server, threaded=True)
+            self.port = self.server.server_port # if port 0 was requested
+            self.thread = threading.Thread(target=self.server.serve_forever, name='pca_dashboard', daemon=True)
+            self.thread.start()
+        self.app.open()
+        return self
+
+    def stop(self):
+        """Stop serving and release the port and the workers of the dashboard (start restarts them)"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = self.thread = None
+        self.app.close()
+
+def run_dashboard(data, labels, store=None, solver='full', n_components=None, workers=None,
+                  host='127.0.0.1', port=8050, background=False, large=None, max_points=5000):
+    """Creates a dashboard for visual exploration of PCA analysis
     
-    app.run_server(debug=False)
+    data: a pandas dataFrame whose columns contain the features on which to perform PCA
+    labels: a pandas dataFrame whose columns contain the labels, the index must be identical to data
+    store: server-side store of the PCA results, e.g. DiskStore('data/pca_dashboard'), in memory by default
+    solver: PCA solver, 'full' (exact), 'randomized' (faster, limited to n_components) or 'incremental'
+            (by batches of samples, for data too large for memory, e.g. a DataFrame of a memory-mapped array)
+    n_components: number of components computed, all for 'full' and 20 for the other solvers by default
+    workers: number of background threads recomputing the PCA (e.g. when the scaling changes)
+    background: serve the dashboard from a background thread and return its DashboardServer (stop it with
+                server.stop()), instead of blocking until the server is stopped
+    large: large data mode (WebGL PC1 x PC2 scatter plot of at most max_points samples at a time, in full resolution
+           when zoomed or selected, and table paginated by the server), by default for more than 2000 samples
+    """
+    app = create_app(data, labels, store=store, solver=solver, n_components=n_components, workers=workers,
+                     large=large, max_points=max_points)
+    if background:
+        return DashboardServer(app, host=host, port=port).start()
+    app.run_server(debug=False, host=host, port=port)
+
+def save_dashboard_data(data, labels, path):
+    """Save the data (samples x features) and labels of a dashboard as a matrix store, to be served with wsgi_app"""
+    return MatrixStore.save(data, path, annotations=labels)
+
+def wsgi_app(path, store_dir=None, solver='full', n_components=None, workers=2, large=None, max_points=5000):
+    """
+    WSGI application of a dashboard of data saved with save_dashboard_data, for a multi-process WSGI server, e.g.
+        gunicorn -w 4 --threads 4 -b 0.0.0.0:8050 "tools.pca_dashboard:wsgi_app('data/pca_dashboard.matrix')"
+    The data is memory-mapped, and the PCA results are shared by the processes through a DiskStore (store_dir,
+    path + '.pca' by default) so that each result is computed once
+    """
+    matrix = MatrixStore(path)
+    data = pd.DataFrame(matrix.values, index=matrix.rows, columns=matrix.columns, copy=False)
+    labels = matrix.annotations()
+    for col in labels.columns:
+        if isinstance(labels[col].dtype, pd.CategoricalDtype):
+            labels[col] = labels[col].astype(object)
+    app = create_app(data, labels, store=DiskStore(store_dir or path.rstrip('/') + '.pca'), solver=solver,
+                     n_components=n_components, workers=workers, large=large, max_points=max_points)
+    return app.server
 
 if __name__ == '__main__':
     
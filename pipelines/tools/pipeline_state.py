@@ -0,0 +1,182 @@
+### Incremental pipeline state: steps are rerun only when their inputs, command or tool version changed ###
+
+import os, json, time, hashlib, sqlite3, threading, shlex
+import subprocess as sp
+from functools import lru_cache
+
+STATE_DB = 'data/pipeline_state.sqlite'
+CHUNK_SIZE = 8 * 1024 * 1024
+
+def run_command(command, prefix=''):
+    """Run a shell command printing its output (each line after prefix), returns the exit code of the command"""
+    prefix = prefix + ' ' if prefix else ''
+    try:
+        process = sp.Popen(shlex.split(command), stdout = sp.PIPE, stderr = sp.STDOUT, shell = False)
+        for line in process.stdout:
+            print(prefix + line.decode("UTF-8").replace('\n',''))
+        return process.wait()
+    except FileNotFoundError:
+        print(prefix + "command not found")
+        return 127
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    """First line printed by `tool --version`, None if the tool is not installed"""
+    try:
+        output = sp.run([tool, '--version'], stdout=sp.PIPE, stderr=sp.STDOUT, timeout=60).stdout
+    except (OSError, sp.TimeoutExpired):
+        return None
+    lines = output.decode('UTF-8', errors='replace').strip().splitlines()
+    return lines[0] if lines else ''
+
+
+class PipelineState():
+    """
+    Record of the steps run for each sample, stored in a SQLite database.
+
+    For each (step, sample), the content hashes of the input files, the command line (or parameters),
+    the tool version and the manifest of the output files are saved once the step succeeded.
+    A step is up to date, and skipped, when none of them changed and its outputs are still on disk untouched,
+    so that reruns are no-ops, crashed steps (never recorded) are rerun and a change of parameter or index reruns
+    the samples depending on it.
+
+        state = PipelineState('data/pipeline_state.sqlite')
+        state.run('salmon', sample, f'salmon quant --index {index} -r {fastq} --output {output}',
+                  inputs=[fastq, index], outputs=[os.path.join(output, 'quant.sf')], version=tool_version('salmon'))
+
+    File hashes are cached by path, size and modification time, so only new or modified files are read.
+    """
+    def __init__(self, db=STATE_DB):
+        if os.path.dirname(db):
+            os.makedirs(os.path.dirname(db), exist_ok=True)
+        self.db = db
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(db, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS file_hashes
+                (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha1 TEXT)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS steps
+                (step TEXT, sample TEXT, signature TEXT, inputs TEXT, command TEXT, version TEXT,
+                 outputs TEXT, duration REAL, completed TEXT, PRIMARY KEY (step, sample))''')
+
+    def close(self):
+        self.connection.close()
+
+    #### hashes ####
+    def file_hash(self, path):
+        """sha1 of the content of a file, or of the relative paths and hashes of the files of a directory"""
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            sha1 = hashlib.sha1()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    full = os.path.join(root, f)
+                    sha1.update(f'{os.path.relpath(full, path)}\t{self.file_hash(full)}\n'.encode())
+            return sha1.hexdigest()
+        stat = os.stat(path)
+        with self._lock:
+            row = self.connection.execute('SELECT size, mtime_ns, sha1 FROM file_hashes WHERE path=?', (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha1.update(block)
+        with self._lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO file_hashes VALUES (?,?,?,?)',
+                                    (path, stat.st_size, stat.st_mtime_ns, sha1.hexdigest()))
+        return sha1.hexdigest()
+
+    def _manifest(self, paths):
+        """{path: hash} of files, None if one of them is missing"""
+        manifest = {}
+        for path in paths:
+            if not os.path.exists(path):
+                return None
+            manifest[path] = self.file_hash(path)
+        return manifest
+
+    @staticmethod
+    def _signature(inputs, command, version):
+        return hashlib.sha1(json.dumps([sorted(inputs.items()), command, version]).encode()).hexdigest()
+
+    #### steps ####
+    def get(self, step, sample):
+        """Record of a step, None if it never succeeded"""
+        with self._lock:
+            row = self.connection.execute('''SELECT signature, inputs, command, version, outputs, duration, completed
+                                             FROM steps WHERE step=? AND sample=?''', (step, sample)).fetchone()
+        if row is None:
+            return None
+        keys = ['signature', 'inputs', 'command', 'version', 'outputs', 'duration', 'completed']
+        record = dict(zip(keys, row))
+        record['inputs'], record['outputs'] = json.loads(record['inputs']), json.loads(record['outputs'])
+        return record
+
+    def is_up_to_date(self, step, sample, inputs, command, version=None):
+        """Whether a step already succeeded with the same inputs, command and version and its outputs were not modified"""
+        record = self.get(step, sample)
+        if record is None:
+            return False
+        manifest = self._manifest(inputs)
+        if manifest is None or record['signature'] != self._signature(manifest, command, version):
+            return False
+        return self._manifest(record['outputs']) == record['outputs']
+
+    def record(self, step, sample, inputs, command, outputs, version=None, duration=None):
+        """Save a successful step"""
+        manifest = self._manifest(inputs)
+        output_manifest = self._manifest(outputs)
+        if manifest is None or output_manifest is None:
+            raise IOError(f'{step} {sample}: missing input or output files')
+        with self._lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO steps VALUES (?,?,?,?,?,?,?,?,?)',
+                                    (step, sample, self._signature(manifest, command, version), json.dumps(manifest),
+                                     json.dumps(command), version, json.dumps(output_manifest), duration,
+                                     time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def invalidate(self, step, sample=None):
+        """Forget a step (for one or all samples) so that it is rerun"""
+        with self._lock, self.connection:
+            if sample is None:
+                self.connection.execute('DELETE FROM steps WHERE step=?', (step,))
+            else:
+                self.connection.execute('DELETE FROM steps WHERE step=? AND sample=?', (step, sample))
+
+    def run(self, step, sample, command, inputs, outputs, version=None, params=None, force=False):
+        """
+        Run a step unless it is up to date, and record it if it succeeds.
+
+        command: shell command, or python function returning an exit code
+        inputs: list of the input files or directories (e.g. fastq files and the index)
+        outputs: list of the output files or directories, or function returning it once the step ran
+        version: version of the tool (see tool_version), a new version reruns the step
+        params: parameters of the step (JSON serialisable), required for a python function command,
+                defaults to the shell command
+        Returns the exit code of the command, 0 if the step was skipped
+        """
+        if params is None:
+            if callable(command):
+                raise ValueError(f'[{step} {sample}] params are required to detect changes of a python function command')
+            params = command
+        if not force and self.is_up_to_date(step, sample, inputs, params, version):
+            print(f'[{step} {sample}] up to date')
+            return 0
+        self.invalidate(step, sample)
+        start = time.time()
+        returncode = command() if callable(command) else run_command(command, prefix=f'[{step} {sample}]')
+        if returncode != 0:
+            return returncode
+        try:
+            self.record(step, sample, inputs, params, outputs() if callable(outputs) else outputs,
+                        version=version, duration=time.time() - start)
+        except IOError as e:
+            print(f'[{step} {sample}]', e)
+            return 1
+        return 0
+
+    def summary(self):
+        """List of (step, sample, completed, duration) of the recorded steps"""
+        with self._lock:
+            return self.connection.execute('SELECT step, sample, completed, duration FROM steps ORDER BY step, sample').fetchall()
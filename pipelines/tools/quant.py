@@ -0,0 +1,90 @@
+### Fast loading of salmon (quant.sf) and kallisto (abundance.tsv) outputs into transcripts x samples matrices ###
+
+import os, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# file name and column names of the quantification outputs
+FORMATS = {
+    'salmon': {'file': 'quant.sf', 'id': 'Name', 'TPM': 'TPM', 'counts': 'NumReads',
+               'length': 'Length', 'efflen': 'EffectiveLength'},
+    'kallisto': {'file': 'abundance.tsv', 'id': 'target_id', 'TPM': 'tpm', 'counts': 'est_counts',
+                 'length': 'length', 'efflen': 'eff_length'},
+}
+
+def quant_files(outdir, quant_type='salmon', prefix=''):
+    """{sample: quantification file} of the sample directories of an output directory (e.g. quant/salmon_output)"""
+    filename = FORMATS[quant_type]['file']
+    samples = sorted(s for s in os.listdir(outdir) if s.startswith(prefix) and os.path.exists(os.path.join(outdir, s, filename)))
+    return {sample: os.path.join(outdir, sample, filename) for sample in samples}
+
+
+def _ids_hash(ids):
+    """Hash of a sequence of transcript IDs (order included), computed with the vectorised pandas hashing"""
+    return hashlib.sha1(pd.util.hash_array(np.asarray(ids, dtype=object)).tobytes()).hexdigest()
+
+
+def load_quants(files, quant_type='salmon', columns=('TPM', 'counts'), dtype=np.float32, check_ids=True,
+                max_workers=8, engine='c'):
+    """
+    Load the quantification files of many samples into transcripts x samples matrices
+
+    files: dict {sample: file} (see quant_files) or list of files (samples are then named after their directory)
+    quant_type: 'salmon' or 'kallisto'
+    columns: quantities to load among 'TPM', 'counts', 'length' and 'efflen'
+    dtype: dtype of the matrices
+    check_ids: how the transcripts of every file are checked against the first file:
+               True (default) compares the transcript IDs (by a hash of the ID column of each file),
+               'length' the transcript lengths only (faster, the IDs are then only read from the first file),
+               False only the number of transcripts.
+    max_workers: number of files read in parallel
+    engine: pandas parser, 'c' or 'pyarrow' (if installed)
+
+    Returns a dict {quantity: DataFrame (transcripts x samples)} indexed by the transcript IDs of the first file.
+    The matrices are preallocated and filled one sample at a time so that loading needs little more than their size.
+    """
+    if not isinstance(files, dict):
+        files = {os.path.basename(os.path.dirname(os.path.abspath(f))): f for f in files}
+    if not files:
+        raise ValueError('no quantification files to load')
+    fmt = FORMATS[quant_type]
+    samples, paths = list(files), list(files.values())
+    value_cols = [fmt[col] for col in columns]
+
+    def read(path, ids=True):
+        dtypes = {col: dtype for col in value_cols}
+        if ids:
+            dtypes[fmt['id']] = str
+        if check_ids == 'length':
+            dtypes[fmt['length']] = np.int64
+        return pd.read_csv(path, sep='\t', usecols=list(dtypes), dtype=dtypes, engine=engine)
+
+    # the first file gives the transcript IDs
+    first = read(paths[0])
+    ids = first[fmt['id']].values
+    lengths = first[fmt['length']].values if check_ids == 'length' else None
+    ids_hash = _ids_hash(ids) if check_ids is True else None
+    n_tx = len(ids)
+    matrices = {col: np.empty((n_tx, len(samples)), dtype=dtype, order='F') for col in columns}
+
+    def fill(j, df):
+        if len(df) != n_tx:
+            raise ValueError(f'{paths[j]}: {len(df)} transcripts, expected {n_tx} as in {paths[0]}')
+        if check_ids == 'length':
+            if not np.array_equal(df[fmt['length']].values, lengths):
+                raise ValueError(f'{paths[j]}: the transcript lengths differ from the ones of {paths[0]}')
+        elif check_ids is True and j > 0 and _ids_hash(df[fmt['id']].values) != ids_hash:
+            raise ValueError(f'{paths[j]}: the transcripts differ from the ones of {paths[0]}')
+        for col, value_col in zip(columns, value_cols):
+            matrices[col][:, j] = df[value_col].values
+
+    fill(0, first)
+    del first
+    def load(j):
+        fill(j, read(paths[j], ids=check_ids is True))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(load, range(1, len(paths)))) # raises the first error
+
+    index = pd.Index(ids, name='IDs')
+    return {col: pd.DataFrame(matrices[col], index=index, columns=samples, copy=False) for col in columns}
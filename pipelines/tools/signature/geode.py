@@ -1,13 +1,192 @@
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from sklearn.decomposition import PCA
+from sklearn.utils.extmath import randomized_svd
+from scipy.sparse import csr_matrix
+from scipy.special import betainc, betaln
 from scipy.stats import chi2
 from scipy.stats.mstats import zscore
+from ..genesets import GeneSetLibrary
 warnings.filterwarnings("ignore", category=DeprecationWarning) 
 warnings.filterwarnings("ignore", category=RuntimeWarning) 
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz # np.trapz was removed in numpy 2.4
 
 
-def chdir(data, sampleclass, genes, gamma=1., sort=True, calculate_sig=False, nnull=10, sig_only=False, norm_vector=True):
+def _check_input(data, sampleclass, genes, gamma):
+	"""Validate the arguments shared by chdir and chdir_batch"""
+	if type(gamma) not in [float, int]:
+		raise ValueError("gamma has to be a numeric number")
+	if set(sampleclass) != set([1,2]) and set(sampleclass) != set([0,1,2]):
+		raise ValueError("sampleclass has to be a list whose elements are in only 0, 1 or 2")
+	# if m1.sum()<2 or m2.sum()<2:
+	# 	raise ValueError("Too few samples to calculate characteristic directions")
+	if len(genes) != data.shape[0]:
+		raise ValueError("Number of genes does not match the demension of the expression matrix")
+
+
+def _masks(sampleclass):
+	"""Return the masks of the included samples, and of the controls and perturbations among them"""
+	m_non0 = [x != 0 for x in sampleclass]
+	m1 = [x == 1 for x in sampleclass if x]
+	m2 = [x == 2 for x in sampleclass if x]
+	return m_non0, m1, m2
+
+
+def _pca(data, solver='full'):
+	"""
+	Perform PCA on the samples of a z-scored data matrix (genes x samples)
+	Input:
+		data: numpy.array, z-scored data matrix where rows correspond to genes and columns correspond to samples
+		solver: str, 'full' to use the exact sklearn PCA, 'gram' to diagonalize the samples x samples Gram matrix or
+			'randomized' to use a randomized SVD limited to the rank of the data. 'gram' and 'randomized' are much 
+			faster and lighter when samples << genes and reuse the SVD factors instead of projecting the data again
+	Output:
+		v: the loadings of the kept PCs (genes x keepPC)
+		r: the samples projected on the kept PCs (samples x keepPC)
+	"""
+	if solver == 'full':
+		## initialize the pca object
+		pca = PCA(n_components=None)
+		pca.fit(data.T)
+
+		## compute the number of PCs to keep
+		cumsum = pca.explained_variance_ratio_ # explained variance of each PC
+		keepPC = len(cumsum[cumsum > 0.001]) # number of PCs to keep
+
+		v = pca.components_[0:keepPC].T # rotated data 
+		r = pca.transform(data.T)[:,0:keepPC] # transformed data
+		return v, r
+
+	## center each gene across samples as done by PCA
+	data = np.asarray(data, dtype=float)
+	data = data - data.mean(axis=1, keepdims=True)
+	total_var = np.einsum('ij,ij->', data, data) # sum of the variances of all PCs (up to a constant)
+
+	if solver == 'gram':
+		## the squared singular values and left singular vectors are the eigen decomposition of the Gram matrix
+		s2, u = np.linalg.eigh(np.dot(data.T, data))
+		s2, u = np.clip(s2[::-1], 0, None), u[:, ::-1] # in decending order
+	elif solver == 'randomized':
+		## the rank of the centered data cannot exceed the number of samples - 1
+		n_components = max(min(data.shape) - 1, 1)
+		u, s, vt = randomized_svd(data.T, n_components=n_components, random_state=0)
+		s2 = s ** 2
+	else:
+		raise ValueError("solver has to be one of 'full', 'gram' or 'randomized'")
+
+	## compute the number of PCs to keep
+	cumsum = s2 / total_var # explained variance of each PC
+	keepPC = len(cumsum[cumsum > 0.001]) # number of PCs to keep
+
+	s = np.sqrt(s2[0:keepPC])
+	r = u[:,0:keepPC] * s # transformed data, i.e. U.S
+	if solver == 'gram':
+		v = np.dot(data, u[:,0:keepPC] / s) # rotated data, i.e. V = X.U.S^-1
+	else:
+		v = vt[0:keepPC].T
+	return v, r
+
+
+def _chdir_vector(v, r, meanvec, m1, m2, gamma):
+	"""Compute the (unnormalized) characteristic direction from the PCA of the data, 
+	along with the covariance and the shrunk inverse covariance matrices in PC space"""
+	n1 = sum(m1) # number of controls
+	n2 = sum(m2) # number of experiments
+	keepPC = v.shape[1]
+
+	dd = ( np.dot(r[m1].T,r[m1]) + np.dot(r[m2].T,r[m2]) ) / float(n1+n2-2) # covariance
+	sigma = np.mean(np.diag(dd)) # the scalar covariance
+
+	shrunkMats = np.linalg.inv(gamma*dd + sigma*(1-gamma)*np.eye(keepPC))
+
+	b = np.dot(v, np.dot(np.dot(v.T, meanvec), shrunkMats))
+	return b, dd, shrunkMats
+
+
+def _check_random_state(random_state):
+	"""Turn a seed into a random generator, None returns the global numpy random state"""
+	if random_state is None:
+		return np.random.mtrand._rand
+	if isinstance(random_state, (np.random.Generator, np.random.RandomState)):
+		return random_state
+	return np.random.default_rng(random_state)
+
+
+def _sorted_null_sum(v, shrunkMats, y, chunksize=100):
+	"""
+	Sum of the null characteristic directions, squared and sorted in decending order
+	The null chdirs v.shrunkMats.v.T.v.y reduce to v.shrunkMats.y as the loadings are orthonormal,
+	so they are computed by blocks of chunksize draws without forming any genes x genes matrix
+	"""
+	proj = np.dot(shrunkMats, v.T) # keepPC x genes
+	total = np.zeros(v.shape[0])
+	for start in range(0, y.shape[1], chunksize):
+		bn = np.dot(y[:, start:start+chunksize].T, proj) # draws x genes
+		bn /= np.linalg.norm(bn, axis=1, keepdims=True)
+		bn **= 2
+		bn.sort(axis=1)
+		total += bn[:, ::-1].sum(axis=0) ## sort in decending order
+	return total
+
+
+def _null_chdirs(v, shrunkMats, y, n_jobs=1):
+	"""Mean of the sorted squared null characteristic directions, optionally computed across a process pool"""
+	nnull = y.shape[1]
+	if n_jobs > 1 and nnull > 1:
+		chunks = np.array_split(y, min(n_jobs, nnull), axis=1)
+		with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+			total = sum(executor.map(_sorted_null_sum, [v]*len(chunks), [shrunkMats]*len(chunks), chunks))
+	else:
+		total = _sorted_null_sum(v, shrunkMats, y)
+	return total / nnull
+
+
+def _null_draws(dd, n1, n2, nnull, random_state=None):
+	"""Draws of the null distribution of the projection of the difference of the group means on the PCs"""
+	keepPC = dd.shape[0]
+	nu = n1 + n2 - 2
+	rng = _check_random_state(random_state)
+	y1 = rng.multivariate_normal(np.zeros(keepPC), dd, nnull).T * np.sqrt(nu / chi2.rvs(nu,size=nnull,random_state=rng))
+	y2 = rng.multivariate_normal(np.zeros(keepPC), dd, nnull).T * np.sqrt(nu / chi2.rvs(nu,size=nnull,random_state=rng))
+	return y2 - y1 ## y is the null of v
+
+
+def _chdir_output(b, genes, sort=True, nullchdirs=None, sig_only=False, return_type='tuples'):
+	"""Format a characteristic direction as returned by chdir, with the significance of the genes given null chdirs"""
+	genes = np.asarray(genes)
+	abs_order = np.argsort(-np.abs(b), kind='stable') # decending absolute values
+	order = abs_order if sort else np.arange(len(b))
+
+	if nullchdirs is None: # return sorted b and genes.
+		if return_type == 'array':
+			return b[order], genes[order]
+		res = list(zip(b[order], genes[order].tolist()))
+		return res
+	else:
+		b_s = b[abs_order] ** 2 # sorted b in decending order
+		relerr = b_s / nullchdirs ## relative error
+		# ratio_to_null
+		ratios = np.cumsum(relerr)/np.sum(relerr)- np.linspace(1./len(b),1,len(b))
+		nsig = np.argmax(ratios)+1
+		print('Number of significant genes: %s'%(nsig))
+		if return_type == 'array':
+			## attach the ratios to their genes so that they stay correct when the output is not sorted
+			gene_ratios = np.empty_like(ratios)
+			gene_ratios[abs_order] = ratios
+			if sig_only:
+				sig = np.zeros(len(b), dtype=bool)
+				sig[abs_order[0:nsig]] = True
+				order = order[sig[order]]
+			return b[order], genes[order], gene_ratios[order]
+		res = list(zip(b[order], genes[order].tolist(), ratios))
+		if sig_only:
+			return res[0:nsig]
+		else:
+			return res
+
+
+def chdir(data, sampleclass, genes, gamma=1., sort=True, calculate_sig=False, nnull=10, sig_only=False, norm_vector=True, solver='full', random_state=None, n_jobs=1, return_type='tuples'):
 	"""
 	Calculate the characteristic direction for a gene expression dataset
 	
@@ -22,27 +201,25 @@ def chdir(data, sampleclass, genes, gamma=1., sort=True, calculate_sig=False, nn
 		nnull: int, number of null characteristic directions to calculate for significance
 		sig_only: bool, whether to return only significant genes; active only when calculate_sig is True
 		norm_vector: bool, whether to return a characteristic direction vector normalized to unit vector
+		solver: str, 'full', 'gram' or 'randomized', the PCA solver. Use 'gram' for wide matrices (samples << genes)
+		random_state: None, int, numpy.random.Generator or numpy.random.RandomState, seed of the null distribution; 
+				None uses the global numpy random state
+		n_jobs: int, number of processes used to compute the null characteristic directions
+		return_type: str, 'tuples' to return a list of tuples or 'array' to return numpy arrays
 	Output:
 		A list of tuples sorted by the absolute value in descending order characteristic directions of genes.
 			If calculate_sig is set to True, each tuple contains a third element which is the ratio of characteristic directions to null ChDir
+		If return_type is 'array', a tuple of numpy.array (chdir, genes) or (chdir, genes, ratios) in the same order
 	"""
 	
 	## check input
 	data.astype(float)
+	_check_input(data, sampleclass, genes, gamma)
+	if return_type not in ['tuples', 'array']:
+		raise ValueError("return_type has to be either 'tuples' or 'array'")
 	# sampleclass = np.array(map(int, sampleclass))
 	# masks
-	m_non0 = [x != 0 for x in sampleclass]
-	m1 = [x == 1 for x in sampleclass if x]
-	m2 = [x == 2 for x in sampleclass if x]
-
-	if type(gamma) not in [float, int]:
-		raise ValueError("gamma has to be a numeric number")
-	if set(sampleclass) != set([1,2]) and set(sampleclass) != set([0,1,2]):
-		raise ValueError("sampleclass has to be a list whose elements are in only 0, 1 or 2")
-	# if m1.sum()<2 or m2.sum()<2:
-	# 	raise ValueError("Too few samples to calculate characteristic directions")
-	if len(genes) != data.shape[0]:
-		raise ValueError("Number of genes does not match the demension of the expression matrix")
+	m_non0, m1, m2 = _masks(sampleclass)
 
 	## normalize data
 	data = data[:, m_non0]
@@ -55,72 +232,214 @@ def chdir(data, sampleclass, genes, gamma=1., sort=True, calculate_sig=False, nn
 	## the difference between experiment mean vector and control mean vector.
 	meanvec = data[:,m2].mean(axis=1) - data[:,m1].mean(axis=1) 
 
-	## initialize the pca object
-	pca = PCA(n_components=None)
-	pca.fit(data.T)
+	v, r = _pca(data, solver=solver)
+	b, dd, shrunkMats = _chdir_vector(v, r, meanvec, m1, m2, gamma)
 
-	## compute the number of PCs to keep
-	cumsum = pca.explained_variance_ratio_ # explained variance of each PC
-	keepPC = len(cumsum[cumsum > 0.001]) # number of PCs to keep
+	if norm_vector:
+		b /= np.linalg.norm(b) # normalize b to unit vector
+
+	if not calculate_sig:
+		return _chdir_output(b, genes, sort=sort, return_type=return_type)
+	else: # generate a null distribution of chdirs
+		y = _null_draws(dd, n1, n2, nnull, random_state)
+		nullchdirs = _null_chdirs(v, shrunkMats, y, n_jobs=n_jobs)
+		return _chdir_output(b, genes, sort=sort, nullchdirs=nullchdirs, sig_only=sig_only, return_type=return_type)
+
+def chdir_batch(data, sampleclasses, genes, gamma=1., norm_vector=True, solver='full'):
+	"""
+	Calculate the characteristic directions of many comparisons performed on the same gene expression dataset
+	The z-scoring is performed once and the PCA is shared between all comparisons using the same samples
+	(e.g. every individual x treatment contrast within a design), so that many contrasts cost about one PCA.
+
+	Input:
+		data: numpy.array, is the data matrix of gene expression where rows correspond to genes and columns correspond to samples
+		sampleclasses: list of sampleclass, one per comparison, each formatted as the sampleclass argument of chdir
+				example: sampleclasses = [[1,1,1,2,2,2,0,0,0], [1,1,1,0,0,0,2,2,2]]
+		genes: list or numpy.array, row labels for genes 
+		gamma: float, regulaized term. A parameter that smooths the covariance matrix and reduces potential noise in the dataset
+		norm_vector: bool, whether to return characteristic direction vectors normalized to unit vectors
+		solver: str, 'full', 'gram' or 'randomized', the PCA solver. Use 'gram' for wide matrices (samples << genes)
+	Output:
+		A numpy.array of characteristic directions where rows correspond to genes and columns correspond to comparisons
+	"""
+	data = np.asarray(data, dtype=float)
+	for sampleclass in sampleclasses:
+		_check_input(data, sampleclass, genes, gamma)
+
+	## z-scoring is performed independently for each sample, so it can be shared by all comparisons
+	used = np.any([np.asarray(sampleclass) != 0 for sampleclass in sampleclasses], axis=0)
+	zdata = np.zeros_like(data)
+	zdata[:, used] = zscore(data[:, used])
+
+	## group the comparisons by sample subset to only perform one PCA per subset
+	subsets = {}
+	for idx, sampleclass in enumerate(sampleclasses):
+		m_non0, m1, m2 = _masks(sampleclass)
+		subsets.setdefault(tuple(m_non0), []).append((idx, m1, m2))
+
+	res = np.zeros((data.shape[0], len(sampleclasses)))
+	for m_non0, contrasts in subsets.items():
+		subdata = zdata[:, list(m_non0)]
+		v, r = _pca(subdata, solver=solver)
+		for idx, m1, m2 in contrasts:
+			meanvec = subdata[:,m2].mean(axis=1) - subdata[:,m1].mean(axis=1)
+			b, dd, shrunkMats = _chdir_vector(v, r, meanvec, m1, m2, gamma)
+			if norm_vector:
+				b /= np.linalg.norm(b) # normalize b to unit vector
+			res[:, idx] = b
+	return res
+
+
+def _row_chunks(data, columns, chunksize, transform=None):
+	"""Chunks of chunksize rows (genes) of the selected columns (samples) of a matrix, as float64 arrays"""
+	for start in range(0, data.shape[0], chunksize):
+		chunk = np.asarray(data[start:start+chunksize], dtype=float)[:, columns]
+		if transform is not None:
+			chunk = transform(chunk)
+		yield slice(start, start+chunk.shape[0]), chunk
+
+
+def _column_moments(data, columns, chunksize, transform=None):
+	"""Mean and standard deviation of each column across rows, merging the moments of the chunks (Chan et al.)"""
+	count, mean, m2 = 0, 0., 0.
+	for rows, chunk in _row_chunks(data, columns, chunksize, transform):
+		n = chunk.shape[0]
+		chunk_mean = chunk.mean(axis=0)
+		chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+		delta = chunk_mean - mean
+		m2 = m2 + chunk_m2 + delta ** 2 * count * n / (count + n)
+		mean = mean + delta * n / (count + n)
+		count += n
+	return mean, np.sqrt(m2 / count)
+
+
+def chdir_streaming(data, sampleclass, genes, gamma=1., sort=True, calculate_sig=False, nnull=10, sig_only=False, norm_vector=True, random_state=None, chunksize=10000, null_batch=100, transform=None, return_type='tuples'):
+	"""
+	Calculate the characteristic direction of a gene expression matrix too large to fit in memory, e.g. a memory-mapped
+	numpy array (np.load(fn, mmap_mode='r') or MatrixStore(path).values) of a cohort of thousands of samples.
+	The matrix is read by chunks of chunksize genes, so that the peak memory is bounded by a few chunks, the
+	samples x samples Gram matrix and a few vectors of the size of the genes (and null_batch of them with calculate_sig).
+	The results are equivalent to chdir(..., solver='gram') on the whole matrix (up to floating point errors):
+		pass 1: mean and standard deviation of each sample (the z-scoring of chdir)
+		pass 2: Gram matrix of the z-scored, centered samples (-> PCA) and projection of the difference of the group
+				means on the samples
+		pass 3: characteristic direction, and the null characteristic directions by batches of null_batch draws
+	The null distribution has the same covariance as in chdir, but its draws for a given random_state may differ as
+	they are sensitive to the rounding errors of the covariance matrix.
+
+	Input:
+		data: numpy.array or numpy.memmap, genes x samples matrix of gene expression
+		transform: function applied to each chunk of the data (float64 array of genes x included samples) before
+				the z-scoring, e.g. lambda x: np.log10(x+1)
+		the other arguments are those of chdir
+	Output:
+		As chdir
+	"""
+	_check_input(data, sampleclass, genes, gamma)
+	if return_type not in ['tuples', 'array']:
+		raise ValueError("return_type has to be either 'tuples' or 'array'")
+	m_non0, m1, m2 = _masks(sampleclass)
+	columns = np.nonzero(m_non0)[0]
+	m1, m2 = np.asarray(m1), np.asarray(m2)
+	n1 = m1.sum() # number of controls
+	n2 = m2.sum() # number of experiments
 
-	v = pca.components_[0:keepPC].T # rotated data 
-	r = pca.transform(data.T)[:,0:keepPC] # transformed data
+	## pass 1: z-scoring parameters of each sample
+	mean, std = _column_moments(data, columns, chunksize, transform)
 
+	def zscored_chunks():
+		"""chunks of the z-scored data centered for each gene (as done by PCA), and the difference of the group means"""
+		for rows, chunk in _row_chunks(data, columns, chunksize, transform):
+			chunk -= mean
+			chunk /= std
+			meanvec = chunk[:, m2].mean(axis=1) - chunk[:, m1].mean(axis=1)
+			chunk -= chunk.mean(axis=1, keepdims=True)
+			yield rows, chunk, meanvec
+
+	## pass 2: PCA from the Gram matrix of the samples, and X.T.meanvec to project meanvec on the PCs
+	gram = np.zeros((len(columns), len(columns)))
+	xt_meanvec = np.zeros(len(columns))
+	for rows, chunk, meanvec in zscored_chunks():
+		gram += np.dot(chunk.T, chunk)
+		xt_meanvec += np.dot(chunk.T, meanvec)
+	s2, u = np.linalg.eigh(gram)
+	s2, u = np.clip(s2[::-1], 0, None), u[:, ::-1] # in decending order
+	cumsum = s2 / np.trace(gram) # explained variance of each PC
+	keepPC = len(cumsum[cumsum > 0.001]) # number of PCs to keep
+	s = np.sqrt(s2[0:keepPC])
+	r = u[:,0:keepPC] * s # transformed data, i.e. U.S
+	us = u[:,0:keepPC] / s # the loadings are V = X.U.S^-1
+
+	## pass 3: b = V.shrunkMats.V.T.meanvec, computed chunk by chunk of V
 	dd = ( np.dot(r[m1].T,r[m1]) + np.dot(r[m2].T,r[m2]) ) / float(n1+n2-2) # covariance
 	sigma = np.mean(np.diag(dd)) # the scalar covariance
-
 	shrunkMats = np.linalg.inv(gamma*dd + sigma*(1-gamma)*np.eye(keepPC))
-
-	b = np.dot(v, np.dot(np.dot(v.T, meanvec), shrunkMats))
+	coefs = np.dot(np.dot(us.T, xt_meanvec), shrunkMats)[None, :]
+	batches = [coefs]
+	if calculate_sig:
+		## the null chdirs are V.shrunkMats.y (see _sorted_null_sum), computed along with b by batches of null_batch draws
+		y = _null_draws(dd, n1, n2, nnull, random_state)
+		batches = [np.dot(shrunkMats, y[:, start:start+null_batch]).T for start in range(0, nnull, null_batch)]
+		batches[0] = np.vstack([coefs, batches[0]])
+	nullchdirs = np.zeros(data.shape[0])
+	for i, coefs in enumerate(batches):
+		projections = np.zeros((coefs.shape[0], data.shape[0]))
+		for rows, chunk, meanvec in zscored_chunks():
+			projections[:, rows] = np.dot(coefs, np.dot(chunk, us).T)
+		if i == 0:
+			b, projections = projections[0], projections[1:]
+		projections /= np.linalg.norm(projections, axis=1, keepdims=True)
+		projections **= 2
+		projections.sort(axis=1)
+		nullchdirs += projections[:, ::-1].sum(axis=0) ## sort in decending order
 
 	if norm_vector:
 		b /= np.linalg.norm(b) # normalize b to unit vector
+	if not calculate_sig:
+		return _chdir_output(b, genes, sort=sort, return_type=return_type)
+	return _chdir_output(b, genes, sort=sort, nullchdirs=nullchdirs / nnull, sig_only=sig_only, return_type=return_type)
 
-	grouped = zip([abs(item) for item in b],b,genes)
-	if sort:
-		grouped = sorted(grouped,key=lambda x: x[0], reverse=True)
 
+def _pac_pval(theta, m, n):
+	"""
+	p value of a principal angle theta between a characteristic direction of n genes and a gene set of m genes,
+	integrated from the null-distribution of principal angles
+	"""
+	# calculation of the null-distribution of principal angles
+	m = float(m)
+	n = float(n)
+	pac = lambda theta: 2.*(1./np.sqrt(2*np.pi))*np.exp((n/2.)*np.log(n/(n - m))+(m/2.)*np.log((n - m)/m)+(1/2.)*np.log(m/(2.*n)*(n - m))+(n-m-1)*np.log(np.sin(theta))+(m-1)*np.log(np.cos(theta)))
+	integration_range = np.linspace(0, theta, num=10000, endpoint=True) ## num seems to matter a lot
+	p_val = trapezoid(pac(integration_range), integration_range)
+	if p_val > 1.:
+		p_val = 1.
+	return p_val
 
-	if not calculate_sig: # return sorted b and genes.
-		res = [(item[1],item[2]) for item in grouped]
-		return res
-	else: # generate a null distribution of chdirs
-		nu = n1 + n2 - 2
-		y1 = np.random.multivariate_normal(np.zeros(keepPC), dd, nnull).T * np.sqrt(nu / chi2.rvs(nu,size=nnull))
-		y2 = np.random.multivariate_normal(np.zeros(keepPC), dd, nnull).T * np.sqrt(nu / chi2.rvs(nu,size=nnull))
-		y = y2 - y1 ## y is the null of v
-
-		nullchdirs = []
-		for col in y.T:
-			bn = np.dot(np.dot(np.dot(v,shrunkMats), v.T), np.dot(col,v.T))
-			bn /= np.linalg.norm(bn)
-			bn = bn ** 2
-			bn.sort()
-			bn = bn[::-1] ## sort in decending order
-			nullchdirs.append(bn)
-
-		nullchdirs = np.array(nullchdirs).T
-		nullchdirs = nullchdirs.mean(axis=1)
-		b_s = b ** 2 
-		b_s.sort()
-		b_s = b_s[::-1] # sorted b in decending order
-		relerr = b_s / nullchdirs ## relative error
-		# ratio_to_null
-		ratios = np.cumsum(relerr)/np.sum(relerr)- np.linspace(1./len(meanvec),1,len(meanvec))
-		res = [(item[1],item[2], ratio) for item, ratio in zip(grouped, ratios)] 
-		print('Number of significant genes: %s'%(np.argmax(ratios)+1))
-		if sig_only:
-			return res[0:np.argmax(ratios)+1]
-		else:
-			return res
 
+def _pac_pvals(theta, m, n):
+	"""
+	p values of principal angles theta between a characteristic direction of n genes and gene sets of m genes,
+	vectorised over gene sets. The null density is proportional to sin(theta)^(n-m-1).cos(theta)^(m-1), so its
+	integral from 0 to theta has the closed form B(a,b).I(sin(theta)^2; a,b)/2 with a=(n-m)/2 and b=m/2,
+	where I is the regularized incomplete beta function. The normalization is the one used by _pac_pval.
+	"""
+	theta = np.asarray(theta, dtype=float)
+	m = np.asarray(m, dtype=float)
+	n = float(n)
+	a = (n - m) / 2.
+	b = m / 2.
+	log_norm = np.log(2.*(1./np.sqrt(2*np.pi))) + (n/2.)*np.log(n/(n - m))+(m/2.)*np.log((n - m)/m)+(1/2.)*np.log(m/(2.*n)*(n - m))
+	p_vals = np.exp(log_norm + betaln(a, b) - np.log(2.)) * betainc(a, b, np.sin(theta) ** 2)
+	return np.minimum(p_vals, 1.)
 
-def paea(chdir, gmtline, case_sensitive=False):
+
+def paea(chdir, gmtline, case_sensitive=False, pval_method='beta'):
 	"""
 	Perform principal angle enrichment analysis (PAEA)
 	Input:
 		chdir, list of tuples: A characteristic direction returned from chdir function
 		gmtline: A list of genes from a gene set 
+		pval_method: 'beta' to use the closed form of the null-distribution or 'trapz' to integrate it numerically
 	Output:
 		a list of tuples in the format of:
 			the principal angle, the p value
@@ -136,7 +455,7 @@ def paea(chdir, gmtline, case_sensitive=False):
 	if len(set(genes_measured)) != len(chdir):
 		raise ValueError('There are duplicated genes in the input genes')
 	
-	mask = np.in1d(genes_measured, gmtline) # gpos in the R script
+	mask = np.isin(genes_measured, gmtline) # gpos in the R script
 	mm = np.where(mask==True)[0]
 	m = mask.sum() # number of overlaping genes
 	n = len(genes_measured)
@@ -151,14 +470,10 @@ def paea(chdir, gmtline, case_sensitive=False):
 		principal_angle = np.linalg.svd(qbqc,compute_uv=False)[0]
 		theta = np.arccos(principal_angle)
 
-		# calculation of the null-distribution of principal angles
-		m = float(m)
-		n = float(n)
-		pac = lambda theta: 2.*(1./np.sqrt(2*np.pi))*np.exp((n/2.)*np.log(n/(n - m))+(m/2.)*np.log((n - m)/m)+(1/2.)*np.log(m/(2.*n)*(n - m))+(n-m-1)*np.log(np.sin(theta))+(m-1)*np.log(np.cos(theta)))
-		integration_range = np.linspace(0, theta, num=10000, endpoint=True) ## num seems to matter a lot
-		p_val = np.trapz(pac(integration_range), integration_range)
-		if p_val > 1.:
-			p_val = 1.
+		if pval_method == 'trapz':
+			p_val = _pac_pval(theta, m, n)
+		else:
+			p_val = _pac_pvals(theta, m, n)[()]
 	else:
 		principal_angle = 0.
 		p_val = 1.
@@ -166,23 +481,19 @@ def paea(chdir, gmtline, case_sensitive=False):
 	return principal_angle, p_val
 
 
-def paea_wrapper(chdir, gmt_fn, case_sensitive=False, sort=True):
+def read_gmt(gmt_fn):
 	"""
-	A wrapper function for PAEA gene-set enrichment analysis
-
+	Read a gene-set library in GMT format
 	Input:
-		chdir: characteristic directions computed by chdir function
 		gmt_fn: file name of a gene-set library in GMT format
-		case_sensitive: whether gene symbols should be considered as case_sensitive
 	Output:
-		a sorted list of tuples (term, p_val)
+		a list of tuples (term, genes)
 	"""
 	## check input:
 	if not gmt_fn.endswith('.gmt'):
 		raise IOError("The gene-set library file is not in GMT format")
 
-	## read gmt into a dict:
-	res = []
+	gene_sets = []
 	with open (gmt_fn) as f:
 		for line in f:
 			sl = line.strip().split('\t')
@@ -190,8 +501,90 @@ def paea_wrapper(chdir, gmt_fn, case_sensitive=False, sort=True):
 			genes = sl[2:]
 			if ',' in genes[0]: ## auto detect fuzzy gmts
 				genes = [gene.split(',')[0] for gene in genes]
-			principal_angle, p_val = paea(chdir, genes, case_sensitive=case_sensitive)
-			res.append( (term, p_val) )
+			gene_sets.append( (term, genes) )
+	return gene_sets
+
+
+def _chdir_arrays(chdir):
+	"""Return the coefficients and the genes of a characteristic direction returned as tuples or as arrays"""
+	if isinstance(chdir, tuple): ## output from which return_type is 'array'
+		return np.asarray(chdir[0], dtype=float), np.asarray(chdir[1])
+	return np.array([item[0] for item in chdir], dtype=float), np.array([item[1] for item in chdir])
+
+
+def _membership_matrix(genes_measured, gene_sets, case_sensitive=False):
+	"""Sparse gene-set x gene indicator matrix of the measured genes belonging to each gene set (Qc in the paper)"""
+	gene_index = {gene: i for i, gene in enumerate(genes_measured)}
+	rows, cols = [], []
+	for row, (term, genes) in enumerate(gene_sets):
+		if not case_sensitive:
+			genes = [gene.upper() for gene in genes]
+		idx = [gene_index[gene] for gene in genes if gene in gene_index]
+		rows += [row] * len(idx)
+		cols += idx
+	membership = csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(len(gene_sets), len(genes_measured)))
+	membership.data[:] = 1. # genes listed twice in a gene set are only counted once
+	return membership
+
+
+def paea_library(chdir, gene_sets, case_sensitive=False, pval_method='beta'):
+	"""
+	Perform principal angle enrichment analysis (PAEA) for all the gene sets of a library at once
+	For a characteristic direction (rank one), the principal angle with a gene set reduces to the norm
+	of the coefficients of its genes, so all terms are scored with one sparse matrix-vector product
+	Input:
+		chdir: A characteristic direction returned from chdir function, as a list of tuples or as arrays
+		gene_sets: A GeneSetLibrary or a list of tuples (term, genes), as returned by read_gmt
+		case_sensitive: whether gene symbols should be considered as case_sensitive
+		pval_method: 'beta' to use the closed form of the null-distribution, vectorised over all gene sets, 
+			or 'trapz' to integrate it numerically for each gene set
+	Output:
+		two numpy.array with the principal angles and the p values of the gene sets
+	"""
+	qb, genes_measured = _chdir_arrays(chdir)
+	if not case_sensitive:
+		genes_measured = np.char.upper(genes_measured.astype(str))
+
+	if len(set(genes_measured)) != len(genes_measured):
+		raise ValueError('There are duplicated genes in the input genes')
+
+	if isinstance(gene_sets, GeneSetLibrary):
+		membership = gene_sets.membership(genes_measured, case_sensitive=case_sensitive)
+	else:
+		membership = _membership_matrix(genes_measured, gene_sets, case_sensitive=case_sensitive)
+	m = np.asarray(membership.sum(axis=1)).ravel() # number of overlaping genes
+	n = len(genes_measured)
+
+	principal_angles = np.sqrt(membership.dot(qb ** 2))
+	p_vals = np.ones(len(m))
+	valid = (m > 1) & (m < n) # if there is overlap between gene set and genes in chdir
+	principal_angles[~valid] = 0.
+	if pval_method == 'trapz':
+		for i in np.where(valid)[0]:
+			p_vals[i] = _pac_pval(np.arccos(principal_angles[i]), m[i], n)
+	elif pval_method == 'beta':
+		p_vals[valid] = _pac_pvals(np.arccos(principal_angles[valid]), m[valid], n)
+	else:
+		raise ValueError("pval_method has to be either 'beta' or 'trapz'")
+	return principal_angles, p_vals
+
+
+def paea_wrapper(chdir, gmt_fn, case_sensitive=False, sort=True, pval_method='beta'):
+	"""
+	A wrapper function for PAEA gene-set enrichment analysis
+
+	Input:
+		chdir: characteristic directions computed by chdir function
+		gmt_fn: file name of a gene-set library in GMT format, or a GeneSetLibrary. 
+			Files are parsed once and cached (see GeneSetLibrary.load)
+		case_sensitive: whether gene symbols should be considered as case_sensitive
+		pval_method: 'beta' (closed form) or 'trapz' (numerical integration), see paea_library
+	Output:
+		a sorted list of tuples (term, p_val)
+	"""
+	library = gmt_fn if isinstance(gmt_fn, GeneSetLibrary) else GeneSetLibrary.load(gmt_fn)
+	principal_angles, p_vals = paea_library(chdir, library, case_sensitive=case_sensitive, pval_method=pval_method)
+	res = list(zip(library.terms.tolist(), p_vals))
 	if sort:## sort terms based on p values in ascending order
 		res = sorted(res, key=lambda x:x[1])
 	else: ## if not sort, return unsorted p_vals only
@@ -12,6 +12,7 @@ import os
 import pandas as pd
 import numpy as np
 from . import geode
+from ..matrix_store import MatrixStore
 
 """
 from rpy2.robjects import r, pandas2ri
@@ -69,7 +70,7 @@ def limma(dataset, group_A, group_B, data='subset'):
 ########## 2. CD
 #############################################
 
-def cd(dataset, group_A, group_B, log=False):
+def cd(dataset, group_A, group_B, log=False, nnull=10, random_state=None):
 
 	# Create sample class
 	sampleclass = []
@@ -87,10 +88,58 @@ def cd(dataset, group_A, group_B, log=False):
 		data = dataset
 
 	# Calculate CD
-	cd = geode.chdir(data=data.values, sampleclass=sampleclass, genes=dataset.index, calculate_sig=True, sig_only=False)
+	cd, genes, significance = geode.chdir(data=data.values, sampleclass=sampleclass, genes=dataset.index, sort=False, calculate_sig=True, sig_only=False, nnull=nnull, random_state=random_state, return_type='array')
 
 	# Create dataframe
-	cd_dataframe = pd.DataFrame(cd, columns=['CD', 'gene_symbol', 'significance']).set_index('gene_symbol').sort_values('CD', ascending=False)
+	order = np.argsort(-cd, kind='stable')
+	cd_dataframe = pd.DataFrame({'CD': cd[order], 'significance': significance[order]}, index=pd.Index(genes[order], name='gene_symbol'))
+
+	# Return
+	return cd_dataframe
+
+
+def cd_streaming(store, group_A, group_B, log=False, nnull=10, random_state=None, chunksize=10000):
+
+	# Memory-mapped expression matrix (MatrixStore or path of a store), read by chunks of genes
+	if not isinstance(store, MatrixStore):
+		store = MatrixStore(store)
+
+	# Create sample class
+	sampleclass = [1 if sample in group_A else 2 if sample in group_B else 0 for sample in store.columns]
+
+	# Log transform, chunk by chunk
+	transform = (lambda x: np.log10(x+1)) if log else None
+
+	# Calculate CD
+	cd, genes, significance = geode.chdir_streaming(data=store.values, sampleclass=sampleclass, genes=store.rows, sort=False, calculate_sig=True, sig_only=False, nnull=nnull, random_state=random_state, chunksize=chunksize, transform=transform, return_type='array')
+
+	# Create dataframe
+	order = np.argsort(-cd, kind='stable')
+	cd_dataframe = pd.DataFrame({'CD': cd[order], 'significance': significance[order]}, index=pd.Index(genes[order], name='gene_symbol'))
+
+	# Return
+	return cd_dataframe
+
+
+def cd_batch(dataset, contrasts, log=False):
+
+	# Create one sample class per contrast
+	sampleclasses = []
+	for group_A, group_B in contrasts.values():
+		sampleclasses.append([1 if sample in group_A else 2 if sample in group_B else 0 for sample in dataset.columns])
+
+	# Log transform
+	if log:
+		data = np.log10(dataset+1)
+	else:
+		data = dataset
+
+	# Calculate all CDs at once, sharing the PCA between contrasts using the same samples
+	cds = geode.chdir_batch(data=data.values, sampleclasses=sampleclasses, genes=dataset.index)
+
+	# Create dataframe
+	cd_dataframe = pd.DataFrame(cds, index=dataset.index, columns=list(contrasts.keys()))
+	cd_dataframe.index.name = 'gene_symbol'
 
 	# Return
 	return cd_dataframe
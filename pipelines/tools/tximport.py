@@ -0,0 +1,165 @@
+### Aggregation of transcript-level estimates to gene level, equivalent to tximport (tx2gene_salmon.R) ###
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from tools.quant import load_quants
+
+COUNTS_FROM_ABUNDANCE = ['no', 'scaledTPM', 'lengthScaledTPM']
+# CSV files of the matrices written by tx2gene_salmon.R
+CSV_FILES = {'abundance': 'txi_tpm.csv', 'counts': 'txi_counts.csv', 'length': 'txi_length.csv',
+             'counts_scaledTPM': 'txi_scaledTPM_counts.csv', 'counts_lengthScaledTPM': 'txi_lengthScaledTPM_counts.csv'}
+
+def tx2gene_from_names(names):
+    """
+    Transcript to gene mapping from Gencode transcript names (ENST...|ENSG...|...|symbol|length|type|),
+    as read from the quant files, without rewriting the files
+    """
+    parts = pd.Series(np.asarray(names)).str.split('|', n=2, expand=True)
+    if parts.shape[1] < 2:
+        raise ValueError('the transcript names do not contain gene IDs, provide a tx2gene table')
+    return pd.DataFrame({'Tx': parts[0].values, 'Gene': parts[1].values})
+
+
+def gene_index(tx_ids, tx2gene, ignore_tx_version=False):
+    """
+    Integer transcript -> gene index
+
+    tx_ids: transcript IDs of the quantification files
+    tx2gene: DataFrame whose first two columns are the transcript and gene IDs (as data/tx2gene.csv)
+    Returns (genes, index): the sorted IDs of the genes of the transcripts and, for each transcript,
+    the position of its gene (-1 if not in tx2gene)
+    """
+    tx = pd.Index(np.asarray(tx2gene.iloc[:, 0]).astype(str))
+    gene_of_tx = np.asarray(tx2gene.iloc[:, 1]).astype(str)
+    tx_ids = pd.Index(np.asarray(tx_ids).astype(str))
+    if ignore_tx_version:
+        tx = tx.str.split('.').str[0]
+        tx_ids = tx_ids.str.split('.').str[0]
+    if not tx.is_unique:
+        keep = ~tx.duplicated()
+        tx, gene_of_tx = tx[keep], gene_of_tx[keep]
+    positions = tx.get_indexer(tx_ids)
+    found = positions >= 0
+    # only the genes of the quantified transcripts are kept
+    genes, codes = np.unique(gene_of_tx[positions[found]], return_inverse=True)
+    index = np.full(len(tx_ids), -1)
+    index[found] = codes
+    return genes, index
+
+
+def summarize_to_gene(abundance, counts, length, genes, index, counts_from_abundance=COUNTS_FROM_ABUNDANCE):
+    """
+    Gene-level abundance, counts and (TPM-weighted effective) length from transcripts x samples matrices,
+    with the same definitions as tximport's summarizeToGene:
+        abundance, counts: sums over the transcripts of each gene
+        length: average of the transcript lengths weighted by their abundance; for genes not expressed in some samples,
+                the geometric mean of the gene length in the other samples, and for genes not expressed in any sample,
+                the average over the transcripts of the gene of their mean length across samples (replaceMissingLength)
+        counts from abundance: abundance (scaledTPM) or abundance x mean gene length across samples (lengthScaledTPM)
+                scaled to the library size of each sample
+    The sums are computed with a sparse genes x transcripts matrix product.
+
+    Returns a dict with the matrices 'abundance', 'counts' and 'length' and the counts 'counts_<mode>' of each mode
+    of counts_from_abundance other than 'no'
+    """
+    abundance, counts, length = [np.asarray(m, dtype=np.float64) for m in (abundance, counts, length)]
+    if isinstance(counts_from_abundance, str):
+        counts_from_abundance = [counts_from_abundance]
+    keep = np.nonzero(index >= 0)[0]
+    if len(keep) < len(index):
+        print(f'transcripts missing from tx2gene: {len(index) - len(keep)}')
+    aggregate = csr_matrix((np.ones(len(keep)), (index[keep], keep)), shape=(len(genes), len(index)))
+
+    gene_abundance = aggregate @ abundance
+    gene_counts = aggregate @ counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gene_length = (aggregate @ (abundance * length)) / gene_abundance
+        n_tx = np.asarray(aggregate.sum(axis=1)).ravel()
+        average_length = (aggregate @ length.mean(axis=1)) / n_tx
+    missing = ~np.isfinite(gene_length)
+    n_missing = missing.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        geometric_mean = np.exp(np.where(missing, 0, np.log(np.where(missing, 1, gene_length))).sum(axis=1)
+                                / (gene_length.shape[1] - n_missing))
+    fill = np.where(n_missing == gene_length.shape[1], average_length, geometric_mean)
+    gene_length[missing] = np.broadcast_to(fill[:, None], gene_length.shape)[missing]
+
+    txi = {'abundance': gene_abundance, 'counts': gene_counts, 'length': gene_length}
+    library_size = gene_counts.sum(axis=0)
+    for mode in counts_from_abundance:
+        if mode == 'no':
+            continue
+        elif mode == 'scaledTPM':
+            new_counts = gene_abundance
+        elif mode == 'lengthScaledTPM':
+            new_counts = gene_abundance * gene_length.mean(axis=1)[:, None]
+        else:
+            raise ValueError(f"counts_from_abundance has to be among {COUNTS_FROM_ABUNDANCE}")
+        txi['counts_' + mode] = new_counts * (library_size / new_counts.sum(axis=0))
+    return txi
+
+
+def tximport(files, quant_type='salmon', tx2gene=None, counts_from_abundance=COUNTS_FROM_ABUNDANCE,
+             ignore_tx_version=False, max_workers=8):
+    """
+    Import transcript-level estimates and summarize them to gene level, computing all countsFromAbundance modes
+    in a single pass over the quant files
+
+    files: dict {sample: quant file} (see tools.quant.quant_files) or list of files
+    quant_type: 'salmon' or 'kallisto'
+    tx2gene: DataFrame of transcript and gene IDs, or the path of a CSV file such as data/tx2gene.csv,
+             by default genes are read from the Gencode transcript names of the quant files
+    counts_from_abundance: modes of counts computed from abundance, among 'no', 'scaledTPM' and 'lengthScaledTPM'
+    ignore_tx_version: ignore the version of the transcript IDs (ENST00000456328.2 -> ENST00000456328)
+
+    Returns a dict of genes x samples DataFrames: 'abundance', 'counts', 'length' and 'counts_scaledTPM',
+    'counts_lengthScaledTPM' for the modes computed
+    """
+    quants = load_quants(files, quant_type=quant_type, columns=('TPM', 'counts', 'efflen'), dtype=np.float64,
+                         max_workers=max_workers)
+    names = quants['TPM'].index
+    if tx2gene is None:
+        tx2gene = tx2gene_from_names(names)
+        tx_ids = tx2gene.Tx.values
+    else:
+        if isinstance(tx2gene, str):
+            tx2gene = pd.read_csv(tx2gene)
+        tx_ids = pd.Series(np.asarray(names)).str.split('|', n=1).str[0].values # trimmed as trim_ids did
+    genes, index = gene_index(tx_ids, tx2gene, ignore_tx_version=ignore_tx_version)
+
+    txi = summarize_to_gene(quants['TPM'].values, quants['counts'].values, quants['efflen'].values, genes, index,
+                            counts_from_abundance=counts_from_abundance)
+    samples = quants['TPM'].columns
+    return {key: pd.DataFrame(values, index=pd.Index(genes), columns=samples) for key, values in txi.items()}
+
+
+def export_csv(txi, outdir):
+    """Write the matrices to the CSV files written by tx2gene_salmon.R"""
+    written = []
+    for key, df in txi.items():
+        written.append(os.path.join(outdir, CSV_FILES[key]))
+        df.to_csv(written[-1])
+    return written
+
+
+def compare_csv(txi, outdir, rtol=1e-6):
+    """
+    Check the matrices against the CSV files written by the R tximport (tx2gene_salmon.R) in outdir,
+    raises an AssertionError if a value differs by more than rtol (relative) or if genes or samples differ
+    Returns the largest relative difference of each matrix
+    """
+    differences = {}
+    for key, df in txi.items():
+        r = pd.read_csv(os.path.join(outdir, CSV_FILES[key]), index_col=0)
+        if set(r.index) != set(df.index) or set(r.columns) != set(df.columns):
+            raise AssertionError(f'{CSV_FILES[key]}: genes or samples differ')
+        expected, values = r.to_numpy(), df.loc[r.index, r.columns].to_numpy()
+        difference = np.abs(values - expected)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.where(difference == 0, 0., difference / np.abs(expected))
+        differences[key] = relative.max() if relative.size else 0.
+        if differences[key] > rtol:
+            raise AssertionError(f'{CSV_FILES[key]}: relative difference of {differences[key]:.3g}')
+    return differences
@@ -1,54 +1,37 @@
 ### Helper functions for the rnaseq pipelines ###
 
 import os, sys
-import ftplib, requests, shlex
-import subprocess as sp
 import tools.progressbar as pg
+import tools.downloads as downloads
+from tools.fastq import dump_compressed, fastq_layout
+from tools.pipeline_state import run_command
 import IPython.display
 
 N_CPU = os.cpu_count()
 
+def _progressbar(filesize):
+    """Text progress bar to follow downloads, see downloads.download_http"""
+    p = pg.Progressbar(filesize)
+    return p.update_progress
+
 def download_file(url, local_filename):
-    with open(local_filename, 'wb') as f:
-        response = requests.get(url, stream=True)
-        filesize = response.headers.get('content-length')
-        if filesize is None:
-            f.write(response.content)
-        else:
-            print('*** Downloading {} (size {} MB) ***'.format(local_filename, filesize))
-            for chunk in pg.log_progress(response.iter_content(chunk_size=max(int(int(filesize)/1000),1024*1024)),every=1):
-                f.write(chunk)
-    return local_filename
+    """Download a file over http(s), resuming partial downloads (see tools.downloads)"""
+    print('*** Downloading {} ***'.format(local_filename))
+    return downloads.download_http(url, local_filename, progress=_progressbar)
 
 def download_ftp(ftp, path_to_remote_file, local_name):
+    """Download a file over ftp, reusing the ftp sessions opened to the same host and resuming partial downloads"""
     if os.path.exists(local_name):
         print(local_name, 'already downloaded')
     else:
-        #open ftp session
-        ftp = ftplib.FTP(ftp)
-        ftp.login()
-        filesize = ftp.size(path_to_remote_file)
-        with open(local_name, 'wb') as f:
-            print('*** Downloading {} (size {} MB) ***'.format(local_name, filesize))
-            p = pg.Progressbar(filesize)
-            def callback(chunk):
-                f.write(chunk)
-                p.update_progress(len(chunk))
+        print('*** Downloading {} ***'.format(local_name))
+        downloads.download_ftp(downloads.get_ftp_pool(ftp), path_to_remote_file, local_name, progress=_progressbar)
 
-            ftp.retrbinary('RETR '+path_to_remote_file, callback, blocksize = max(int(int(filesize)/1000),1024*1024))
-        ftp.quit() #close session
+def download_files(urls, outdir, max_connections=4):
+    """Download files concurrently to outdir (e.g. SraRunInfo.download_path), skipping the files already downloaded"""
+    return downloads.DownloadManager(max_connections=max_connections).download_all(
+        [(url, os.path.join(outdir, url.split('/')[-1])) for url in urls])
 
 def display_link(url):
     raw_html = f'<a href="{url}" target="_blank">{url}</a>'
     return IPython.display.display(IPython.display.HTML(raw_html))
-
-#helper function to run shell commands
-def run_command(command):
-    try:
-        process = sp.Popen(shlex.split(command), stdout = sp.PIPE, stderr = sp.STDOUT, shell = False)
-        for line in process.stdout:
-            print(line.decode("UTF-8").replace('\n',''))
-    except sp.CalledProcessError as e:
-        raise Exception("Error running", command, e.output)
-    except FileNotFoundError:
-        print("command not found")
\ No newline at end of file
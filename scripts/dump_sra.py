@@ -2,9 +2,13 @@
 # This script converts sra files to fastq format using fasterq-dump and performs QC using fastQC
 
 #imports
-import os, sys, shlex
+import os, sys, time
 from argparse import ArgumentParser
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipelines'))
+from tools.fastq import dump_compressed, LAYOUT_SUFFIX
+from tools.pipeline_state import PipelineState, run_command, tool_version
 
 ## parse arguments and check folder exists
 parser = ArgumentParser()
@@ -12,10 +16,30 @@ parser.add_argument("-s" ,"--sradir", dest="sradir",
                     help="Directory containing SRA files", metavar="DIR", type=str)
 parser.add_argument("-o", "--outdir", dest="outdir",
                     help="Output directory to store fastq files", metavar="DIR", type=str)
+parser.add_argument("-j", "--jobs", dest="jobs", default=1,
+                    help="Maximum number of tasks (dump or QC) running at the same time", metavar="N", type=int)
+parser.add_argument("-t", "--threads-per-job", dest="threads_per_job", default=1,
+                    help="Number of threads used by each fasterq-dump task (fastqc is single-threaded)", metavar="N", type=int)
+parser.add_argument("-c", "--cpus", dest="cpus", default=os.cpu_count(),
+                    help="Total number of CPUs shared by all running tasks (default: all)", metavar="N", type=int)
+parser.add_argument("-z", "--gzip", dest="gzip", action="store_true",
+                    help="Compress the reads while they are dumped, writing .fastq.gz files instead of .fastq files")
+parser.add_argument("-l", "--level", dest="level", default=6,
+                    help="Compression level (1-9) used with --gzip", metavar="N", type=int)
+parser.add_argument("--compress-threads", dest="compress_threads", default=None,
+                    help="Number of threads of each compressor used with --gzip (default: --threads-per-job), "
+                         "a compressed dump uses the threads of fasterq-dump and of two compressors (one per mate)", metavar="N", type=int)
+parser.add_argument("--compressor", dest="compressor", default='auto', choices=['auto', 'pigz', 'bgzip', 'python', 'python-bgzf'],
+                    help="Compressor used with --gzip: pigz if installed (auto), bgzip (BGZF), or the built-in parallel gzip/BGZF writer")
+parser.add_argument("--state", dest="state", default='data/pipeline_state.sqlite',
+                    help="Database recording the steps already run, which are skipped unless their inputs, command or tool version changed", metavar="FILE", type=str)
+parser.add_argument("-f", "--force", dest="force", action="store_true",
+                    help="Rerun all steps, even the ones which are up to date")
 args = parser.parse_args()
 
 SRADIR = vars(args)['sradir']
 OUTDIR = vars(args)['outdir']
+QCDIR = 'data/fastqc_output'
 
 if SRADIR is None:
     print("You must provide an input directory containing sra files")
@@ -23,10 +47,12 @@ if SRADIR is None:
 elif not os.path.isdir(SRADIR):
     print(f'input folder {SRADIR} not found')
     sys.exit()
-    
+
 if OUTDIR is None:
     OUTDIR = 'fastq/'
 
+compress_threads = args.compress_threads or args.threads_per_job
+
 try:
     os.makedirs(OUTDIR)
 except FileExistsError:
@@ -40,36 +66,140 @@ if len(sra_files) == 0:
     sys.exit()
 
 
-#helper function to run shell commands
-def run_command(command):
-    try:
-        process = sp.Popen(shlex.split(command), stdout = sp.PIPE, stderr = sp.STDOUT, shell = False)
-        idx=0
-        for line in process.stdout:
-            print(idx, line.decode("UTF-8").replace('\n',''))
-    except sp.CalledProcessError as e:
-        raise Exception("Error running", command, e.output)
-    except FileNotFoundError:
-        print("command not found")
-
-########## Step 1: Dump ##########
-print("Starting Dump")
-for file in sra_files:
-    filename = os.path.join(SRADIR, file)
-    print('dumping', filename)
-    run_command(f'fasterq-dump --outdir {OUTDIR} {filename}')
-    
-    
-########## Step 2: QC ##########
-print("Starting QC analysis")
+class Task():
+    """
+    A shell command (or a python function returning an exit code) using a number of CPUs,
+    and the function creating the tasks which depend on it
+    """
+    def __init__(self, name, command, threads=1, next_tasks=None):
+        self.name = name
+        self.command = command
+        self.threads = threads
+        self.next_tasks = next_tasks
+        self.status = 'pending'
+        self.returncode = None
+        self.duration = 0.
+
+    def run(self):
+        start = time.time()
+        if callable(self.command):
+            self.returncode = self.command()
+        else:
+            self.returncode = run_command(self.command, prefix=f'[{self.name}]')
+        self.duration = time.time() - start
+        return self
+
+
+def schedule(tasks, jobs=1, cpus=os.cpu_count()):
+    """
+    Run tasks concurrently, starting a task only when the CPUs it needs are available.
+    When a task succeeds, the tasks which depend on it (task.next_tasks()) are scheduled, when it fails they are not.
+    """
+    pending, running, done = list(tasks), {}, []
+    used_cpus = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # start as many pending tasks as the CPU budget allows, a task larger than the budget runs alone
+            for task in list(pending):
+                if len(running) >= jobs:
+                    break
+                if running and used_cpus + task.threads > cpus:
+                    continue
+                pending.remove(task)
+                task.status = 'running'
+                used_cpus += task.threads
+                running[executor.submit(task.run)] = task
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                used_cpus -= task.threads
+                if future.exception() is not None or task.returncode != 0:
+                    task.status = 'failed'
+                    print(f'[{task.name}] failed (exit code {task.returncode})')
+                else:
+                    task.status = 'done'
+                    if task.next_tasks is not None:
+                        pending += task.next_tasks()
+                done.append(task)
+    return done
+
+
+def fastq_files(sample):
+    """fastq files dumped from a sample"""
+    return sorted(os.path.join(OUTDIR, f) for f in os.listdir(OUTDIR) if f.startswith(sample + '.') and f.endswith(('.fastq', '.fastq.gz')))
+
+
+def qc_task(fastq):
+    """QC task of a fastq file, skipped if the report of the same file is up to date"""
+    name = os.path.basename(fastq)
+    report = os.path.join(QCDIR, name.replace('.gz', '').replace('.fastq', '') + '_fastqc')
+    command = f'fastqc {fastq} --outdir {QCDIR}'
+    return Task(f'fastqc {name}', lambda: state.run('fastqc', name, command, inputs=[fastq], outputs=[report + '.html', report + '.zip'],
+                                                    version=tool_version('fastqc'), force=args.force))
+
+
+def qc_tasks(sample):
+    """QC tasks of the fastq files produced by the dump of a sample"""
+    return [qc_task(fastq) for fastq in fastq_files(sample)]
+
+
+def compressed_dump(filename, sample):
+    """Dump task streaming the reads of a sra file to compressed fastq files, see tools.fastq.dump_compressed"""
+    def dump():
+        try:
+            result = dump_compressed(filename, OUTDIR, threads=args.threads_per_job, level=args.level, compressor=args.compressor,
+                                     compress_threads=compress_threads)
+        except (sp.CalledProcessError, OSError, ValueError) as e:
+            print(f'[dump {sample}]', e)
+            return getattr(e, 'returncode', 1)
+        print(f'[dump {sample}]', f"{result['layout']} layout, {result['spots']} spots written to", ', '.join(result['files'] + result['unpaired']))
+        return 0
+    return dump
+
+
+def dump_task(filename, sample):
+    """Dump task of a sra file followed by the QC of its fastq files, skipped if the same file was already dumped the same way"""
+    if args.gzip:
+        command = compressed_dump(filename, sample)
+        params = {'outdir': OUTDIR, 'gzip': True, 'level': args.level}
+        # fasterq-dump and the compressors of both mates (the file of unpaired reads, if any, gets few of them)
+        threads = args.threads_per_job + 2 * compress_threads
+        # the layout detected while dumping is part of the outputs
+        outputs = lambda: fastq_files(sample) + [os.path.join(OUTDIR, os.path.basename(filename) + LAYOUT_SUFFIX)]
+    else:
+        # --force: a crashed or invalidated dump is rerun over the partial fastq files it left
+        command = f'fasterq-dump --force --outdir {OUTDIR} {filename} -e {args.threads_per_job}'
+        params = {'outdir': OUTDIR, 'gzip': False}
+        threads = args.threads_per_job
+        outputs = lambda: fastq_files(sample)
+    dump = lambda: state.run('dump', sample, command, inputs=[filename], outputs=outputs,
+                             version=tool_version('fasterq-dump'), params=params, force=args.force)
+    return Task(f'dump {sample}', dump, threads=threads, next_tasks=lambda: qc_tasks(sample))
+
 
 try:
-    os.makedirs('data/fastqc_output')
+    os.makedirs(QCDIR)
 except FileExistsError:
     # directory already exists
     pass
 
-fastq_files = [f for f in os.listdir(OUTDIR) if f.endswith('.fastq')]
-for fastq in fastq_files:
-    filename = os.path.join(OUTDIR,fastq)
-    run_command(f'fastqc {filename} --outdir data/fastqc_output')
+########## Dump and QC ##########
+# Each sample is dumped then its fastq files go through QC, so that the QC of a sample overlaps with the dump of the next ones
+print("Starting Dump and QC analysis")
+state = PipelineState(args.state)
+tasks = []
+for file in sorted(sra_files):
+    filename = os.path.join(SRADIR, file)
+    sample = file.split('.')[0]
+    tasks.append(dump_task(filename, sample))
+
+done = schedule(tasks, jobs=args.jobs, cpus=args.cpus)
+
+########## Summary ##########
+print('\nSummary:')
+for task in done:
+    print(f'{task.name:50s} {task.status:8s} exit code: {task.returncode!s:5s} {task.duration:8.1f} s')
+failed = [task for task in done if task.status == 'failed']
+print(f'{len(done)-len(failed)} tasks succeeded, {len(failed)} failed')
+sys.exit(1 if failed else 0)